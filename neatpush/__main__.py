@@ -1,10 +1,23 @@
+import time
+from pathlib import Path
+
+import orjson
 import structlog
 import typer
 import uvicorn
 from uvicorn.config import LOGGING_CONFIG
 
-from neatpush.app import check_new_chapters
-from neatpush.manga import _get_s3_client, retrieve_cached_mangas, save_cached_mangas
+from neatpush.app import check_new_chapters, notify
+from neatpush.config import CFG, setup_logging
+from neatpush.manga import (
+    _get_s3_client,
+    compact_mangas,
+    get_state_store,
+    retrieve_cached_mangas,
+    save_cached_mangas,
+)
+from neatpush.sharding import LeaseManager, Shard, merge_shards
+from neatpush.state import sync_stores
 
 logger = structlog.getLogger("neatpush")
 
@@ -43,21 +56,46 @@ def run_server(
 
 
 @cli.command("run")
-def run() -> None:
-    check_new_chapters()
+def run(
+    shard: str | None = typer.Option(None, help="only check the shard 'i/N'"),
+    lease: bool = typer.Option(False, help="claim shards through leases"),
+    budget: float | None = typer.Option(
+        CFG.RUN_BUDGET, help="seconds after which the run stops, resumed by the next"
+    ),
+) -> None:
+    if shard is not None:
+        check_new_chapters(shard=Shard.parse(shard), budget=budget)
+    elif lease:
+        # a single budget for all the shards claimed
+        deadline = time.monotonic() + budget if budget is not None else None
+        leases = LeaseManager(_get_s3_client(), ttl=CFG.LEASE_TTL)
+        for claimed, lost in leases.claim_shards(CFG.SHARD_COUNT, deadline=deadline):
+            left = deadline - time.monotonic() if deadline is not None else None
+            if left is not None and left <= 0:
+                break  # released for another worker to take over
+            check_new_chapters(shard=claimed, budget=left, lost=lost)
+    else:
+        check_new_chapters(budget=budget)
+
+
+@cli.command("merge")
+def merge(
+    shards: int = typer.Option(CFG.SHARD_COUNT, help="number of shards to merge"),
+) -> None:
+    merge_shards(shards, notify=notify)
 
 
 # @cli.command("rmcache")
 # def rmcache() -> None:
-#     bucket = _get_s3_client()
-#     save_cached_mangas(bucket, mangas=[])
+#     store = get_state_store()
+#     save_cached_mangas(store, mangas=[])
 #     logger.info("Removed cached manga")
 
 
 @cli.command("poplast")
 def poplast(name: str = typer.Option(default="omniscient-reader")) -> None:
-    s3client = _get_s3_client()
-    mangas = retrieve_cached_mangas(s3client)
+    store = get_state_store()
+    mangas = retrieve_cached_mangas(store)
 
     chapter = None
     for manga in mangas:
@@ -66,9 +104,88 @@ def poplast(name: str = typer.Option(default="omniscient-reader")) -> None:
             break
 
     if chapter:
-        save_cached_mangas(s3client, mangas=mangas)
+        save_cached_mangas(store, mangas=mangas)
         logger.info(f"Pop last '{name}' chapter ({chapter})")
 
 
+@cli.command("compact")
+def compact(
+    keep: int = typer.Option(CFG.CHAPTER_RETENTION or 50, help="chapters to keep"),
+    archive: bool = typer.Option(CFG.CHAPTER_ARCHIVE, "--archive/--no-archive"),
+) -> None:
+    store = get_state_store()
+    mangas = retrieve_cached_mangas(store)
+    before = sum(m.n_chapters for m in mangas)
+
+    mangas = compact_mangas(store, mangas, keep=keep, archive=archive)
+    save_cached_mangas(store, mangas=mangas)
+
+    after = sum(m.n_chapters for m in mangas)
+    logger.info("compacted-state", nchapters_before=before, nchapters_after=after)
+
+
+@cli.command("sync")
+def sync(
+    src: str = typer.Option("s3", help="state backend to read from (s3/sqlite)"),
+    dst: str = typer.Option("sqlite", help="state backend to write to (s3/sqlite)"),
+) -> None:
+    sync_stores(get_state_store(src), get_state_store(dst))
+
+
+@cli.command("subscribers")
+def subscribers() -> None:
+    from neatpush.tenants import get_watchlist, load_subscribers
+
+    if CFG.SUBSCRIPTIONS_PATH is None:
+        raise typer.BadParameter("SUBSCRIPTIONS_PATH is not set")
+
+    subscribers = load_subscribers(CFG.SUBSCRIPTIONS_PATH)
+    watchlist = get_watchlist(subscribers)
+    logger.info(
+        "subscribers",
+        nsubscribers=len(subscribers),
+        nsubscriptions=sum(len(s.watched) for s in subscribers),
+        ntitles=sum(len(names) for names in watchlist.values()),
+    )
+
+
+@cli.command("loadtest")
+def loadtest(
+    titles: int = typer.Option(20, help="number of titles served by each fake site"),
+    chapters: int = typer.Option(100, help="number of chapters per title"),
+    latency: float = typer.Option(0.05, help="mean latency of the fake sites (s)"),
+    error_rate: float = typer.Option(0.0, help="ratio of failing requests"),
+    runs: int = typer.Option(3, help="number of get_new_chapters runs"),
+    requests: int = typer.Option(10, help="number of requests sent to the app"),
+    concurrency: int = typer.Option(4, help="concurrent requests sent to the app"),
+) -> None:
+    from neatpush.loadtest import SiteProfile, run_loadtest
+
+    setup_logging(level=CFG.LOG_LEVEL)
+    profile = SiteProfile(
+        ntitles=titles, nchapters=chapters, latency=latency, error_rate=error_rate
+    )
+    run_loadtest(profile, runs=runs, requests=requests, concurrency=concurrency)
+
+
+@cli.command("benchfetch")
+def benchfetch(
+    titles: int = typer.Option(5, help="number of titles served by each fake site"),
+    chapters: int = typer.Option(100, help="number of chapters per title"),
+    latency: float = typer.Option(0.05, help="mean latency of the fake sites (s)"),
+    output: Path = typer.Option(
+        Path("fetch-benchmark.json"), help="where to record the results"
+    ),
+) -> None:
+    from neatpush.loadtest import SiteProfile, run_fetch_benchmark
+
+    setup_logging(level=CFG.LOG_LEVEL)
+    profile = SiteProfile(ntitles=titles, nchapters=chapters, latency=latency)
+    results = run_fetch_benchmark(profile)
+    output.write_bytes(
+        orjson.dumps([r.to_dict() for r in results], option=orjson.OPT_INDENT_2)
+    )
+
+
 if __name__ == "__main__":
     cli()
@@ -1,18 +1,26 @@
 from __future__ import annotations
 
+import queue
+import threading
+import time
+from collections.abc import AsyncIterator, Callable
 from typing import Any
 
+import anyio
+import apprise
 import orjson
 import structlog
 from apprise import NotifyFormat
 from starlette.applications import Starlette
 from starlette.requests import Request
-from starlette.responses import JSONResponse, Response
+from starlette.responses import JSONResponse, Response, StreamingResponse
 from starlette.routing import Route
 
-from neatpush import manga
-from neatpush.config import CFG, setup_logging
+from neatpush import manga, tenants
+from neatpush.config import CFG, LazyRepr, setup_logging
 from neatpush.scraping import MangaChapter
+from neatpush.sharding import Shard, save_shard_notifs
+from neatpush.state import MemoryStateStore
 
 logger = structlog.getLogger("neatpush")
 
@@ -42,25 +50,213 @@ def _format_notif_infos(
     return title, body
 
 
-def check_new_chapters() -> dict[str, list[MangaChapter]]:
-    map_new_chapters = manga.get_new_chapters()
+def _summarize_chapters(
+    map_new_chapters: dict[str, list[MangaChapter]],
+) -> dict[str, list[float]]:
+    return {
+        name: [c.num for c in chapters] for name, chapters in map_new_chapters.items()
+    }
+
+
+def _send(
+    manager: apprise.Apprise, map_new_chapters: dict[str, list[MangaChapter]]
+) -> None:
+    title, body = _format_notif_infos(map_new_chapters)
+    manager.notify(
+        title=title,
+        body=body,
+        body_format=NotifyFormat.MARKDOWN,
+    )
+
+
+def notify(map_new_chapters: dict[str, list[MangaChapter]]) -> None:
+    logger.info(
+        "notifying",
+        nmangas=len(map_new_chapters),
+        chapters=LazyRepr(_summarize_chapters, map_new_chapters),
+    )
+
+    if CFG.SUBSCRIPTIONS_PATH is None:
+        _send(CFG.notif_manager, map_new_chapters)
+        return
+
+    subscribers = tenants.load_subscribers(CFG.SUBSCRIPTIONS_PATH)
+    for manager, batch in tenants.fan_out(subscribers, map_new_chapters):
+        logger.debug("notifying-batch", ntargets=len(manager), nmangas=len(batch))
+        _send(manager, batch)
+
+
+# state of the server, loaded on startup
+_state_store: MemoryStateStore | None = None
+
 
+def check_new_chapters(
+    shard: Shard | None = None,
+    *,
+    budget: float | None = None,
+    lost: threading.Event | None = None,
+) -> dict[str, list[MangaChapter]]:
+    store = _state_store if shard is None else None
+    map_new_chapters = manga.get_new_chapters(
+        shard=shard, budget=budget, store=store, lost=lost
+    )
+
+    if lost is not None and lost.is_set():
+        # left to the worker which took the shard over
+        return {}
     if map_new_chapters:
-        logger.info("notifying", **map_new_chapters)
-        title, body = _format_notif_infos(map_new_chapters)
+        if shard is None:
+            notify(map_new_chapters)
+        else:
+            # notified by the merge step, once all shards are done
+            save_shard_notifs(manga._get_s3_client(), shard, map_new_chapters)
+
+    return map_new_chapters
+
+
+class _CheckCache:
+    """Last completed check, served while a refresh runs in the background.
+
+    Runs are single-flight: a run requested while another one is in progress waits for
+    it and returns its result instead of scraping again.
+    """
+
+    def __init__(self) -> None:
+        self.result: dict[str, list[MangaChapter]] = {}
+        self.completed_at: float | None = None
+        self.running = threading.Lock()
+        self.refresher: threading.Thread | None = None
+
+    @property
+    def age(self) -> float | None:
+        if self.completed_at is None:
+            return None
+        return time.monotonic() - self.completed_at
+
+    def run(self) -> dict[str, list[MangaChapter]]:
+        requested_at = time.monotonic()
+        with self.running:
+            if self.completed_at is not None and self.completed_at >= requested_at:
+                return self.result  # completed by a concurrent run meanwhile
+            self.result = check_new_chapters()
+            self.completed_at = time.monotonic()
+            return self.result
+
+    def run_streaming(
+        self,
+        on_check: Callable[[manga.MangaCheck], object],
+        cancel: threading.Event | None = None,
+    ) -> dict[str, list[MangaChapter]]:
+        """Run a check under the same lock, handing over each manga once checked."""
+        with self.running:
+            map_new_chapters: dict[str, list[MangaChapter]] = {}
+            for check in manga.iter_new_chapters(cancel=cancel, store=_state_store):
+                on_check(check)
+                if check.new_chapters:
+                    map_new_chapters[check.name] = check.new_chapters
 
-        CFG.notif_manager.notify(
-            title=title,
-            body=body,
-            body_format=NotifyFormat.MARKDOWN,
+            if map_new_chapters:
+                notify(map_new_chapters)
+            if cancel is None or not cancel.is_set():  # partial results are not cached
+                self.result = map_new_chapters
+                self.completed_at = time.monotonic()
+            return map_new_chapters
+
+    def refresh(self) -> None:
+        if self.running.locked():
+            return
+        self.refresher = threading.Thread(
+            target=self.run, name="neatpush-refresh", daemon=True
         )
+        self.refresher.start()
 
-    return map_new_chapters
+
+_check_cache = _CheckCache()
 
 
 async def trigger_chapters_check(request: Request) -> ORJSONReponse:
-    map_new_chapters = check_new_chapters()
-    return ORJSONReponse(map_new_chapters)
+    """Check for new chapters, GET requests being served from the cache.
+
+    A result older than CHECK_CACHE_TTL is still served, while a refresh runs in the
+    background. POST requests (the scheduled trigger) and `?fresh=1` always wait for
+    a new check.
+    """
+    fresh = request.method == "POST" or request.query_params.get("fresh") == "1"
+    age = _check_cache.age
+
+    if fresh or age is None:
+        map_new_chapters = await anyio.to_thread.run_sync(_check_cache.run)
+        status, age = "MISS", 0.0
+    else:
+        map_new_chapters = _check_cache.result
+        status = "HIT" if age < CFG.CHECK_CACHE_TTL else "STALE"
+        if status == "STALE":
+            _check_cache.refresh()
+
+    headers = {"X-Cache": status, "Age": str(int(age))}
+    return ORJSONReponse(map_new_chapters, headers=headers)
+
+
+def _check_payload(check: manga.MangaCheck) -> dict[str, Any]:
+    if not check.checked:
+        status = "error"
+    elif check.first_time:
+        status = "first-time"
+    elif check.new_chapters:
+        status = "new-chapters"
+    else:
+        status = "nothing-new"
+    return {
+        "name": check.name,
+        "status": status,
+        "new_chapters": check.new_chapters,
+        "errors": {source.value: repr(exc) for source, exc in check.errors.items()},
+        "elapsed": round(check.elapsed, 3),
+    }
+
+
+async def stream_chapters_check(request: Request) -> StreamingResponse:
+    """Stream the result of each manga as soon as it is checked.
+
+    Results are sent as Server-Sent Events if asked for by the Accept header, as
+    newline delimited JSON otherwise. A client disconnecting cancels the check, the
+    titles checked so far being saved and notified.
+    """
+    sse = "text/event-stream" in request.headers.get("accept", "")
+    cancel = threading.Event()
+    checks: queue.Queue[manga.MangaCheck | Exception | None] = queue.Queue()
+
+    def _check() -> None:
+        try:
+            _check_cache.run_streaming(checks.put, cancel=cancel)
+        except Exception as exc:
+            logger.exception("failed-check")
+            checks.put(exc)
+        finally:
+            checks.put(None)
+
+    def _render(payload: dict[str, Any], event: str | None = None) -> bytes:
+        content = orjson.dumps(payload)
+        if not sse:
+            return content + b"\n"
+        prefix = f"event: {event}\n".encode() if event else b""
+        return prefix + b"data: " + content + b"\n\n"
+
+    async def _stream() -> AsyncIterator[bytes]:
+        threading.Thread(target=_check, name="neatpush-check", daemon=True).start()
+        try:
+            while (item := await anyio.to_thread.run_sync(checks.get)) is not None:
+                if isinstance(item, Exception):
+                    # for the client to tell a failed check from a complete one
+                    yield _render({"status": "failed", "error": repr(item)}, "error")
+                else:
+                    yield _render(_check_payload(item))
+        finally:
+            # the client went away, or the check is done
+            cancel.set()
+
+    media_type = "text/event-stream" if sse else "application/x-ndjson"
+    return StreamingResponse(_stream(), media_type=media_type)
 
 
 async def ping(request: Request) -> Response:
@@ -69,6 +265,7 @@ async def ping(request: Request) -> Response:
 
 routes = [
     Route("/", endpoint=trigger_chapters_check, methods=["POST", "GET"]),
+    Route("/stream", endpoint=stream_chapters_check, methods=["POST", "GET"]),
     Route("/ping", endpoint=ping, methods=["GET"]),
 ]
 
@@ -78,3 +275,22 @@ app = Starlette(debug=True, routes=routes)
 @app.on_event("startup")
 def _setup_logs_for_app() -> None:
     setup_logging(level=CFG.LOG_LEVEL)
+
+
+@app.on_event("startup")
+def _load_state() -> None:
+    global _state_store
+    _state_store = MemoryStateStore(
+        manga.get_state_store(),
+        snapshot=CFG.STATE_SNAPSHOT_PATH,
+        flush_interval=CFG.STATE_FLUSH_INTERVAL,
+        flush_after=CFG.STATE_FLUSH_AFTER,
+    )
+
+
+@app.on_event("shutdown")
+def _flush_state() -> None:
+    global _state_store
+    if _state_store is not None:
+        _state_store.close()
+        _state_store = None
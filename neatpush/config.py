@@ -1,9 +1,16 @@
+import atexit
+import contextlib
 import logging
+import queue
+import random
 import sys
+import threading
+from collections.abc import Callable
 from pathlib import Path
-from typing import Literal
+from typing import IO, Any, Literal
 
 import apprise
+import orjson
 import pydantic
 import structlog
 from pydantic.types import SecretStr
@@ -21,6 +28,10 @@ class Config(BaseSettings):
     )
 
     LOG_LEVEL: Literal["debug", "info", "warning", "error"] = "info"
+    # JSON lines written in the background in production, "auto" only renders for
+    # humans on a TTY. Debug events are sampled at LOG_DEBUG_SAMPLE_RATE.
+    LOG_FORMAT: Literal["auto", "console", "json"] = "auto"
+    LOG_DEBUG_SAMPLE_RATE: float = 1.0
 
     # Scaleway limitation: env variable can't start with "SCW" (reserved)
     # https://www.scaleway.com/en/docs/compute/containers/reference-content/containers-limitations/
@@ -32,12 +43,72 @@ class Config(BaseSettings):
     BUCKET_NAME: str = "messy"
     BUCKET_KEY: str = "neatpush.json"
 
+    # Retries of failing bucket requests, and hedging of slow GET requests
+    S3_RETRY_MAX_ATTEMPTS: int = 5
+    S3_RETRY_DEADLINE: float = 30.0
+    S3_HEDGE_GETS: bool = False
+
+    # Where the known chapters are persisted: the bucket or a local sqlite db
+    STATE_BACKEND: Literal["s3", "sqlite"] = "s3"
+    STATE_SQLITE_PATH: Path = PKG_DIR / "neatpush.sqlite"
+    # Start from an empty state if the bucket object is missing, instead of failing
+    STATE_ALLOW_MISSING: bool = False
+
+    # The server keeps the state in memory, flushed every STATE_FLUSH_INTERVAL seconds
+    # or after STATE_FLUSH_AFTER changed mangas. It is also written to the local
+    # STATE_SNAPSHOT_PATH if set, only safe when the server is its sole writer.
+    STATE_FLUSH_INTERVAL: float = 30.0
+    STATE_FLUSH_AFTER: int = 50
+    STATE_SNAPSHOT_PATH: Path | None = None
+
     # Simple Push
     SIMPLE_PUSH_KEY: SecretStr = SecretStr("")
 
     # Push Technulus
     TECHULUS_PUSH_KEY: SecretStr = SecretStr("")
 
+    # Multi-tenant mode, subscribers watchlists and notification targets are read from
+    # this JSON file instead of the lists and push keys below (see neatpush.tenants).
+    SUBSCRIPTIONS_PATH: Path | None = None
+
+    NEATMANGA_URL: str = "https://neatmanga.com"
+    MANGAPILL_URL: str = "https://mangapill.com"
+    TOONILY_URL: str = "https://toonily.net"
+
+    # Number of chapters kept per manga (all if unset), older ones being moved to an
+    # archive object if CHAPTER_ARCHIVE.
+    CHAPTER_RETENTION: int | None = None
+    CHAPTER_ARCHIVE: bool = True
+
+    # Sharding of the watchlist across workers claiming shards through leases,
+    # LEASE_TTL should be shorter than the interval in between two runs.
+    SHARD_COUNT: int = 1
+    LEASE_TTL: int = 300
+
+    # Seconds a result of `GET /` is served as is, then refreshed in the background
+    CHECK_CACHE_TTL: float = 300
+
+    # Runs given a time budget (`neatpush run --budget`) check the titles most overdue
+    # for a chapter first, judging by the pace of their last PACE_WINDOW chapters. The
+    # state is saved every CHECKPOINT_EVERY titles, if set.
+    RUN_BUDGET: float | None = None
+    CHECKPOINT_EVERY: int | None = None
+    PACE_WINDOW: int = 5
+
+    # Pages are fetched concurrently, and parsed in a process pool if PARSE_WORKERS > 0
+    FETCH_WORKERS: int = 8
+    PARSE_WORKERS: int = 0
+    # Seconds a fallback fetch strategy is used before trying cheaper ones again
+    FETCH_STRATEGY_TTL: float = 3600
+
+    # A manga listed in several sources is checked on all of them, and notified by the
+    # first one publishing a chapter. A source leading less than RACE_SLOW_LEAD_RATIO
+    # of the chapters (once RACE_MIN_SAMPLES are seen) is only checked every
+    # RACE_SLOW_POLL_EVERY runs. Use "name=slug" when a source has its own slug.
+    RACE_MIN_SAMPLES: int = 5
+    RACE_SLOW_LEAD_RATIO: float = 0.1
+    RACE_SLOW_POLL_EVERY: int = 4
+
     NEATMANGA: list[str] = pydantic.Field(default_factory=list)
     MANGAPILL: list[str] = pydantic.Field(default_factory=list)
     TOONILY: list[str] = pydantic.Field(default_factory=list)
@@ -65,21 +136,111 @@ class Config(BaseSettings):
 CFG = Config()
 
 
-def setup_logging(level: str = "info") -> None:
-    structlog.configure(
-        processors=[
-            structlog.contextvars.merge_contextvars,
-            structlog.processors.add_log_level,
+class LazyRepr:
+    """Log value only formatted if the event is rendered, for large payloads."""
+
+    def __init__(self, fn: Callable[..., Any], *args: Any) -> None:
+        self.fn = fn
+        self.args = args
+
+    def __repr__(self) -> str:
+        return str(self.fn(*self.args))
+
+
+class _QueueWriter:
+    """File like object handing log lines over to a background writer thread."""
+
+    def __init__(self, stream: IO[bytes]) -> None:
+        self.stream = stream
+        self.lines: queue.SimpleQueue[bytes | None] = queue.SimpleQueue()
+        self.thread = threading.Thread(
+            target=self._run, name="neatpush-logs", daemon=True
+        )
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self) -> None:
+        while (line := self.lines.get()) is not None:
+            try:
+                self.stream.write(line)
+                if self.lines.empty():
+                    self.stream.flush()
+            except (OSError, ValueError):  # e.g. stdout closed, logs are dropped
+                pass
+        with contextlib.suppress(OSError, ValueError):
+            self.stream.flush()
+
+    def write(self, line: bytes) -> None:
+        self.lines.put(line)
+
+    def flush(self) -> None:
+        pass  # flushed by the writer thread once idle
+
+    def close(self) -> None:
+        if self.thread.is_alive():
+            self.lines.put(None)
+            self.thread.join()
+
+
+_log_writer: _QueueWriter | None = None
+
+
+def _get_log_writer() -> _QueueWriter:
+    global _log_writer
+    if _log_writer is None:
+        _log_writer = _QueueWriter(sys.stdout.buffer)
+    return _log_writer
+
+
+def _sample_debug(rate: float) -> structlog.types.Processor:
+    def _sample(
+        logger: Any, method_name: str, event_dict: structlog.types.EventDict
+    ) -> structlog.types.EventDict:
+        if method_name == "debug" and random.random() >= rate:  # noqa: S311
+            raise structlog.DropEvent
+        return event_dict
+
+    return _sample
+
+
+def setup_logging(level: str = "info", fmt: str | None = None) -> None:
+    fmt = fmt or CFG.LOG_FORMAT
+    if fmt == "auto":
+        fmt = "console" if sys.stderr.isatty() else "json"
+
+    processors: list[structlog.types.Processor] = []
+    if CFG.LOG_DEBUG_SAMPLE_RATE < 1:
+        # first, for dropped events to cost nothing more
+        processors.append(_sample_debug(CFG.LOG_DEBUG_SAMPLE_RATE))
+    processors += [
+        structlog.contextvars.merge_contextvars,
+        structlog.processors.add_log_level,
+    ]
+
+    logger_factory: Any
+    if fmt == "json":
+        processors += [
+            structlog.processors.TimeStamper(fmt="iso", utc=True),
+            structlog.processors.dict_tracebacks,
+            structlog.processors.JSONRenderer(serializer=orjson.dumps),
+        ]
+        logger_factory = structlog.BytesLoggerFactory(file=_get_log_writer())  # type: ignore[arg-type]
+    else:
+        processors += [
             structlog.processors.StackInfoRenderer(),
             structlog.dev.set_exc_info,
             structlog.processors.TimeStamper(fmt="iso", utc=False),
             structlog.dev.ConsoleRenderer(sort_keys=False, colors=sys.stderr.isatty()),
-        ],
+        ]
+        logger_factory = structlog.PrintLoggerFactory()
+
+    structlog.configure(
+        processors=processors,
         wrapper_class=structlog.make_filtering_bound_logger(
             getattr(logging, level.upper())
         ),
         context_class=dict,
-        logger_factory=structlog.PrintLoggerFactory(),
+        logger_factory=logger_factory,
     )
 
     for _logger_name in ["uvicorn", "uvicorn.error"]:
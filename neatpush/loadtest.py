@@ -0,0 +1,468 @@
+"""Offline load-testing harness.
+
+Local stand-ins for the scraped sites (Madara based neatmanga/toonily and mangapill)
+and for the S3 bucket, so that neatpush can be driven at scale without reaching
+any external service.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import hashlib
+import os
+import random
+import re
+import socket
+import statistics
+import threading
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import UTC, datetime, timedelta
+from typing import Any
+
+import httpx
+import structlog
+import uvicorn
+from pydantic import SecretStr
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, Response
+from starlette.routing import Route
+
+from neatpush.config import CFG
+from neatpush.s3 import AWSv4Auth
+
+logger = structlog.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SiteProfile:
+    ntitles: int = 20
+    nchapters: int = 100
+    latency: float = 0.05  # mean of an exponential distribution, in seconds
+    error_rate: float = 0.0
+    seed: int = 0
+    # Bytes of the manga pages besides the chapters list (cover, synopsis, scripts...)
+    page_overhead: int = 50_000
+
+    def titles(self, site: str) -> list[str]:
+        return [f"{site}-title-{i}" for i in range(self.ntitles)]
+
+
+class _FakeSite:
+    def __init__(self, profile: SiteProfile, name: str) -> None:
+        self.profile = profile
+        self.titles = profile.titles(name)
+        self.random = random.Random(profile.seed)  # noqa: S311
+        self.nrequests = 0
+
+    async def delay_or_fail(self) -> Response | None:
+        self.nrequests += 1
+        if self.profile.latency:
+            await asyncio.sleep(self.random.expovariate(1 / self.profile.latency))
+        if self.random.random() < self.profile.error_rate:
+            return Response("Internal Server Error", status_code=500)
+        return None
+
+    @property
+    def page_filler(self) -> str:
+        return f"<script>{'x' * self.profile.page_overhead}</script>"
+
+    def chapters(self, name: str) -> list[tuple[int, datetime]]:
+        if name not in self.titles:
+            return []
+        start = datetime(2024, 1, 1, tzinfo=UTC)
+        return [
+            (num, start + timedelta(days=num))
+            for num in range(self.profile.nchapters, 0, -1)
+        ]
+
+
+def _madara_chapters(request: Request, site: _FakeSite, name: str) -> str:
+    base_url = str(request.base_url).rstrip("/")
+    items = (
+        f'<li class="wp-manga-chapter">'
+        f'<a href="{base_url}/manga/{name}/chapter-{num}/">Chapter {num}</a>'
+        f'<span class="chapter-release-date"><i>{ts:%B %d, %Y}</i></span>'
+        f"</li>"
+        for num, ts in site.chapters(name)
+    )
+    return f'<ul class="main version-chap">{"".join(items)}</ul>'
+
+
+def fake_madara_app(profile: SiteProfile, name: str) -> Starlette:
+    """Madara wordpress theme, as used by neatmanga and toonily."""
+    site = _FakeSite(profile, name)
+
+    async def ajax_chapters(request: Request) -> Response:
+        if error := await site.delay_or_fail():
+            return error
+        name = request.path_params["name"]
+        if name not in site.titles:
+            return Response(status_code=404)
+        return HTMLResponse(_madara_chapters(request, site, name))
+
+    async def manga_page(request: Request) -> Response:
+        if error := await site.delay_or_fail():
+            return error
+        name = request.path_params["name"]
+        if name not in site.titles:
+            return Response(status_code=404)
+        chapters = _madara_chapters(request, site, name)
+        return HTMLResponse(
+            f"<html><body><h1>{name}</h1>{site.page_filler}{chapters}</body></html>"
+        )
+
+    app = Starlette(
+        routes=[
+            # wordpress answers with and without the trailing slash, without redirect
+            Route("/manga/{name}/ajax/chapters/", ajax_chapters, methods=["POST"]),
+            Route("/manga/{name}/ajax/chapters", ajax_chapters, methods=["POST"]),
+            Route("/manga/{name}/", manga_page, methods=["GET"]),
+        ]
+    )
+    app.state.site = site
+    return app
+
+
+def fake_mangapill_app(profile: SiteProfile) -> Starlette:
+    site = _FakeSite(profile, "mangapill")
+
+    async def quick_search(request: Request) -> Response:
+        if error := await site.delay_or_fail():
+            return error
+        name = request.query_params.get("q", "")
+        if name not in site.titles:
+            return HTMLResponse("<div>No results</div>")
+        idx = site.titles.index(name)
+        return HTMLResponse(f'<div><a href="/manga/{idx}/{name}">{name}</a></div>')
+
+    async def manga_page(request: Request) -> Response:
+        if error := await site.delay_or_fail():
+            return error
+        idx, name = request.path_params["idx"], request.path_params["name"]
+        items = (
+            f'<a href="/chapters/{idx}-{num}/{name}-chapter-{num}">Chapter {num}</a>'
+            for num, _ in site.chapters(name)
+        )
+        return HTMLResponse(
+            f"<html><body>{site.page_filler}{''.join(items)}</body></html>"
+        )
+
+    app = Starlette(
+        routes=[
+            Route("/quick-search", quick_search, methods=["GET"]),
+            Route("/manga/{idx}/{name}", manga_page, methods=["GET"]),
+        ]
+    )
+    app.state.site = site
+    return app
+
+
+# -- S3
+
+
+_PATTERN_AUTHORIZATION = re.compile(
+    r"AWS4-HMAC-SHA256 Credential=(?P<access_key>[^/]+)/(?P<scope>[^,]+),"
+    r" SignedHeaders=(?P<signed_headers>[^,]+), Signature=(?P<signature>\w+)"
+)
+
+
+def _s3_error(code: str, status_code: int) -> Response:
+    content = (
+        f"<?xml version='1.0' encoding='UTF-8'?><Error><Code>{code}</Code></Error>"
+    )
+    return Response(content, status_code=status_code, media_type="application/xml")
+
+
+def fake_s3_app(access_key: str, secret_key: str, region: str) -> Starlette:
+    """In-memory S3 stand-in which checks the SigV4 signatures of `AWSv4Auth`."""
+    auth = AWSv4Auth(access_key=access_key, secret_key=secret_key, region=region)
+    objects: dict[str, bytes] = {}
+
+    def check_signature(request: Request, body: bytes) -> Response | None:
+        match = _PATTERN_AUTHORIZATION.fullmatch(
+            request.headers.get("authorization", "")
+        )
+        if match is None or match["access_key"] != access_key:
+            return _s3_error("InvalidAccessKeyId", 403)
+
+        payload_hash = request.headers.get("x-amz-content-sha256", "")
+        if payload_hash != hashlib.sha256(body).hexdigest():
+            return _s3_error("XAmzContentSHA256Mismatch", 400)
+
+        dt = datetime.strptime(
+            request.headers["x-amz-date"] + "+0000", "%Y%m%dT%H%M%SZ%z"
+        )
+        url = httpx.URL(
+            f"https://{request.headers['host']}{request.url.path}",
+            params=sorted(request.query_params.items()),
+        )
+        headers = {h: request.headers[h] for h in match["signed_headers"].split(";")}
+        _, signature = auth.aws4_signature(
+            dt, request.method, url, headers, payload_hash
+        )
+        if signature != match["signature"]:
+            return _s3_error("SignatureDoesNotMatch", 403)
+
+        return None
+
+    async def handle(request: Request) -> Response:
+        body = await request.body()
+        if error := check_signature(request, body):
+            return error
+
+        key = f"{request.path_params['bucket']}/{request.path_params['key']}"
+        if request.method == "PUT":
+            objects[key] = body
+            return Response(status_code=200)
+        elif request.method == "DELETE":
+            objects.pop(key, None)
+            return Response(status_code=204)
+        elif key not in objects:
+            return _s3_error("NoSuchKey", 404)
+        else:
+            return Response(objects[key], media_type="application/octet-stream")
+
+    async def list_objects(request: Request) -> Response:
+        if error := check_signature(request, await request.body()):
+            return error
+
+        bucket = request.path_params["bucket"]
+        prefix = f"{bucket}/{request.query_params.get('prefix', '')}"
+        contents = "".join(
+            f"<Contents><Key>{key.removeprefix(f'{bucket}/')}</Key>"
+            f"<LastModified>{datetime.now(tz=UTC).isoformat()}</LastModified>"
+            f"<ETag>&quot;{hashlib.md5(content).hexdigest()}&quot;</ETag>"  # noqa: S324
+            f"<Size>{len(content)}</Size><StorageClass>STANDARD</StorageClass>"
+            f"</Contents>"
+            for key, content in sorted(objects.items())
+            if key.startswith(prefix)
+        )
+        return Response(
+            f'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f"<Name>{bucket}</Name><IsTruncated>false</IsTruncated>{contents}"
+            f"</ListBucketResult>",
+            media_type="application/xml",
+        )
+
+    app = Starlette(
+        routes=[
+            Route("/{bucket}", list_objects, methods=["GET"]),
+            Route("/{bucket}/{key:path}", handle, methods=["GET", "PUT", "DELETE"]),
+        ]
+    )
+    app.state.objects = objects
+    return app
+
+
+# -- Local stack
+
+
+class ServerThread:
+    """Uvicorn server running `app` in a background thread on a free local port."""
+
+    def __init__(self, app: Starlette) -> None:
+        self.app = app
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.bind(("127.0.0.1", 0))
+        self.port = self.socket.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+
+        config = uvicorn.Config(app, log_level="warning", lifespan="off")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(
+            target=self.server.run, kwargs={"sockets": [self.socket]}, daemon=True
+        )
+
+    def __enter__(self) -> ServerThread:
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.server.should_exit = True
+        self.thread.join()
+
+
+@contextlib.contextmanager
+def override_config(**values: Any) -> Iterator[None]:
+    """Override `CFG` values.
+
+    Plain string values (e.g. the sites urls) are exported to the environment as well,
+    so that spawned parsing processes see them.
+    """
+    previous = {key: getattr(CFG, key) for key in values}
+    previous_env = {key: os.environ.get(key) for key in values}
+    for key, value in values.items():
+        setattr(CFG, key, value)
+        if isinstance(value, str):
+            os.environ[key] = value
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            setattr(CFG, key, value)
+        for key, env_value in previous_env.items():
+            if env_value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = env_value
+
+
+@dataclass
+class LocalStack:
+    neatmanga: ServerThread
+    mangapill: ServerThread
+    toonily: ServerThread
+    s3: ServerThread
+
+
+@contextlib.contextmanager
+def local_stack(profile: SiteProfile) -> Iterator[LocalStack]:
+    """Serve the fake sites & bucket, and point `CFG` at them."""
+    access_key, secret_key, region = "loadtest", "loadtest-secret", "fr-par"
+
+    stack = LocalStack(
+        neatmanga=ServerThread(fake_madara_app(profile, "neatmanga")),
+        mangapill=ServerThread(fake_mangapill_app(profile)),
+        toonily=ServerThread(fake_madara_app(profile, "toonily")),
+        s3=ServerThread(fake_s3_app(access_key, secret_key, region)),
+    )
+
+    with contextlib.ExitStack() as exit_stack:
+        for server in (stack.neatmanga, stack.mangapill, stack.toonily, stack.s3):
+            exit_stack.enter_context(server)
+
+        exit_stack.enter_context(
+            override_config(
+                NEATMANGA_URL=stack.neatmanga.url,
+                MANGAPILL_URL=stack.mangapill.url,
+                TOONILY_URL=stack.toonily.url,
+                BUCKET_ENDPOINT_URL=stack.s3.url,
+                CLOUD_ACCESS_KEY=access_key,
+                CLOUD_SECRET_KEY=SecretStr(secret_key),
+                CLOUD_REGION_NAME=region,
+                STATE_BACKEND="s3",
+                STATE_ALLOW_MISSING=True,
+                NEATMANGA=profile.titles("neatmanga"),
+                MANGAPILL=profile.titles("mangapill"),
+                TOONILY=profile.titles("toonily"),
+            )
+        )
+        yield stack
+
+
+# -- Driver
+
+
+@dataclass
+class LatencyStats:
+    name: str
+    latencies: list[float] = field(default_factory=list)
+    elapsed: float = 0.0
+    nitems: int = 0  # items processed, e.g. titles checked by a run
+
+    def quantile(self, q: float) -> float:
+        if len(self.latencies) < 2:
+            return self.latencies[0] if self.latencies else 0.0
+        return statistics.quantiles(self.latencies, n=100, method="inclusive")[
+            round(q * 100) - 1
+        ]
+
+    @property
+    def throughput(self) -> float:
+        return self.nitems / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name}: {len(self.latencies)} calls, {self.throughput:.2f} items/s,"
+            f" p50={self.quantile(0.5):.3f}s p95={self.quantile(0.95):.3f}s"
+            f" p99={self.quantile(0.99):.3f}s"
+        )
+
+
+def _measure(
+    stats: LatencyStats, fn: Callable[[], Any], ncalls: int, concurrency: int
+) -> None:
+    def timed(_: int) -> None:
+        start = time.perf_counter()
+        fn()
+        stats.latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(timed, range(ncalls)))
+    stats.elapsed += time.perf_counter() - start
+
+
+def run_loadtest(
+    profile: SiteProfile, *, runs: int = 3, requests: int = 10, concurrency: int = 4
+) -> list[LatencyStats]:
+    from starlette.testclient import TestClient
+
+    from neatpush.app import app
+    from neatpush.manga import get_new_chapters
+
+    ntitles = 3 * profile.ntitles  # every title is watched on the three sources
+
+    with local_stack(profile):
+        runs_stats = LatencyStats(name="get_new_chapters", nitems=runs * ntitles)
+        _measure(runs_stats, get_new_chapters, ncalls=runs, concurrency=1)
+
+        app_stats = LatencyStats(name="POST /", nitems=requests)
+        with TestClient(app) as client:
+            _measure(
+                app_stats,
+                lambda: client.post("/").raise_for_status(),
+                ncalls=requests,
+                concurrency=concurrency,
+            )
+
+    results = [runs_stats, app_stats]
+    for stats in results:
+        logger.info("loadtest", result=str(stats))
+    return results
+
+
+@dataclass
+class FetchStats(LatencyStats):
+    nbytes: int = 0  # downloaded by all calls
+
+    def __str__(self) -> str:
+        mean_bytes = self.nbytes // max(len(self.latencies), 1)
+        return f"{super().__str__()}, {mean_bytes} bytes/call"
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "name": self.name,
+            "calls": len(self.latencies),
+            "bytes_per_call": self.nbytes // max(len(self.latencies), 1),
+            "p50": round(self.quantile(0.5), 4),
+            "p95": round(self.quantile(0.95), 4),
+        }
+
+
+def run_fetch_benchmark(profile: SiteProfile) -> list[FetchStats]:
+    """Compare the bytes & latency of the fetch strategies of each site."""
+    from neatpush.scraping import FETCH_STRATEGIES
+
+    results: list[FetchStats] = []
+    with local_stack(profile):
+        for site, strategies in FETCH_STRATEGIES.items():
+            for strategy, fetch in strategies:
+                stats = FetchStats(name=f"{site}/{strategy}", nitems=profile.ntitles)
+                for title in profile.titles(site):
+                    start = time.perf_counter()
+                    stats.nbytes += len(fetch(title).encode())
+                    stats.latencies.append(time.perf_counter() - start)
+                stats.elapsed = sum(stats.latencies)
+                results.append(stats)
+
+    for stats in results:
+        logger.info("fetch-benchmark", result=str(stats))
+    return results
@@ -1,41 +1,27 @@
-import enum
+from __future__ import annotations
+
+import math
+import threading
+from collections import Counter
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from typing import TYPE_CHECKING
 
-import orjson
 import structlog
-from pydantic import BaseModel, field_validator
 
 from neatpush import scraping
 from neatpush.config import CFG
-from neatpush.s3 import S3Client
+from neatpush.models import Manga, MangaSource, RunCursor
+from neatpush.s3 import RetryPolicy, S3Client
 from neatpush.scraping import MangaChapter
+from neatpush.state import S3StateStore, SQLiteStateStore, StateStore
+from neatpush.tenants import get_watchlist, load_subscribers
 
-logger = structlog.getLogger(__name__)
-
+if TYPE_CHECKING:
+    from neatpush.sharding import Shard
 
-class MangaSource(str, enum.Enum):
-    neatmanga = "neatmanga"
-    mangapill = "mangapill"
-    toonily = "toonily"
-
-
-class Manga(BaseModel):
-    name: str
-    source: MangaSource
-    chapters: list[MangaChapter]
-
-    @property
-    def n_chapters(self) -> int:
-        return len(self.chapters)
-
-    @field_validator("chapters")
-    @classmethod
-    def _sort_chapters(cls, values: list[MangaChapter]) -> list[MangaChapter]:
-        return sorted(values, key=lambda x: x.num)
-
-    def __repr__(self) -> str:
-        return f"<Manga {self.name} - {self.source}> #{self.n_chapters} chapters"
-
-    __str__ = __repr__
+logger = structlog.getLogger(__name__)
 
 
 def _get_s3_client() -> S3Client:
@@ -45,87 +31,342 @@ def _get_s3_client() -> S3Client:
         bucket=CFG.BUCKET_NAME,
         base_url=CFG.BUCKET_ENDPOINT_URL,
         region=CFG.CLOUD_REGION_NAME,
+        retry_policy=RetryPolicy(
+            max_attempts=CFG.S3_RETRY_MAX_ATTEMPTS, deadline=CFG.S3_RETRY_DEADLINE
+        ),
+        hedge_gets=CFG.S3_HEDGE_GETS,
     )
 
 
-def retrieve_cached_mangas(s3client: S3Client) -> list[Manga]:
-    content = s3client.download(CFG.BUCKET_KEY)
-    raw = orjson.loads(content)
-    return [Manga(**e) for e in raw]
-
-
-def save_cached_mangas(s3client: S3Client, *, mangas: list[Manga]) -> None:
-    content = orjson.dumps([m.dict() for m in mangas])
-    s3client.upload(CFG.BUCKET_KEY, content, is_public=True)
-
-
-def get_new_chapters(
-    map_manga_source: dict[MangaSource, list[str]] | None = None,
-) -> dict[str, list[MangaChapter]]:
-    map_manga_source = map_manga_source or {
+def get_state_store(
+    backend: str | None = None, *, shard: Shard | None = None
+) -> StateStore:
+    backend = backend or CFG.STATE_BACKEND
+    if backend == "s3":
+        if shard is None:
+            return S3StateStore(
+                _get_s3_client(),
+                key=CFG.BUCKET_KEY,
+                allow_missing=CFG.STATE_ALLOW_MISSING,
+            )
+        # shard states are created by the first run of their shard
+        key = shard.key(CFG.BUCKET_KEY)
+        return S3StateStore(_get_s3_client(), key=key, allow_missing=True)
+    elif backend == "sqlite":
+        path = shard.key(CFG.STATE_SQLITE_PATH) if shard else CFG.STATE_SQLITE_PATH
+        return SQLiteStateStore(path)
+    else:
+        raise ValueError(f"Unknown state backend '{backend}'")
+
+
+def retrieve_cached_mangas(store: StateStore) -> list[Manga]:
+    return store.load()
+
+
+def save_cached_mangas(store: StateStore, *, mangas: list[Manga]) -> None:
+    store.save(mangas)
+
+
+def compact_mangas(
+    store: StateStore, mangas: list[Manga], *, keep: int, archive: bool = True
+) -> list[Manga]:
+    """Apply the retention policy, optionally archiving compacted chapters."""
+    compacted: list[Manga] = []
+    for manga in mangas:
+        manga, archived = manga.compact(keep)
+        if archived:
+            logger.debug("compacted", name=manga.name, narchived=len(archived))
+            if archive:
+                store.archive(manga.name, archived)
+        compacted.append(manga)
+    return compacted
+
+
+map_source_scrapers: dict[MangaSource, tuple[scraping.FetchFn, scraping.ParseFn]] = {
+    MangaSource.neatmanga: (
+        scraping.fetch_with_fallback("neatmanga"),
+        scraping.parse_neatmanga,
+    ),
+    MangaSource.mangapill: (
+        scraping.fetch_with_fallback("mangapill"),
+        scraping.parse_mangapill,
+    ),
+    MangaSource.toonily: (
+        scraping.fetch_with_fallback("toonily"),
+        scraping.parse_toonily,
+    ),
+}
+
+
+def get_map_manga_source() -> dict[MangaSource, list[str]]:
+    """The configured watchlist, shared by all subscribers in multi-tenant mode."""
+    if CFG.SUBSCRIPTIONS_PATH is not None:
+        return get_watchlist(load_subscribers(CFG.SUBSCRIPTIONS_PATH))
+
+    return {
         MangaSource.mangapill: CFG.MANGAPILL,
         MangaSource.neatmanga: CFG.NEATMANGA,
         MangaSource.toonily: CFG.TOONILY,
     }
 
-    logger.debug("checking-sources", **map_manga_source)
 
-    map_source_fn = {
-        MangaSource.neatmanga: scraping.scrap_neatmanga,
-        MangaSource.mangapill: scraping.scrap_mangapill,
-        MangaSource.toonily: scraping.scrap_toonily,
-    }
+def _get_watchlist(
+    map_manga_source: dict[MangaSource, list[str]], shard: Shard | None = None
+) -> dict[str, dict[MangaSource, str]]:
+    """Map each watched manga to its sources, and the slug it has on them."""
+    watchlist: dict[str, dict[MangaSource, str]] = {}
+    for source, entries in map_manga_source.items():
+        for entry in entries:
+            name, _, slug = entry.partition("=")
+            if shard is None or shard.owns(name):
+                watchlist.setdefault(name, {})[source] = slug or name
+    return watchlist
 
-    s3client = _get_s3_client()
-    mangas = retrieve_cached_mangas(s3client)
-    map_name_cache = {m.name: m for m in mangas}
 
-    updated_mangas: list[Manga] = []
-    to_notify_map: dict[str, list[MangaChapter]] = {}
+@dataclass
+class MangaCheck:
+    """Outcome of checking a manga on all its sources."""
 
-    for source, names in map_manga_source.items():
-        scrap_fn = map_source_fn[source]
-        if scrap_fn is None:
-            continue
+    name: str
+    manga: Manga | None  # updated state, unset if never scraped successfully
+    first_time: bool
+    new_chapters: list[MangaChapter] = field(default_factory=list)
+    checked: list[MangaSource] = field(default_factory=list)  # scraped successfully
+    errors: dict[MangaSource, Exception] = field(default_factory=dict)
+    elapsed: float = 0.0
+
+
+def iter_checks(
+    watchlist: dict[str, dict[MangaSource, str]],
+    cache: dict[str, Manga],
+    *,
+    cancel: scraping.CancelFlag | None = None,
+) -> Iterator[MangaCheck]:
+    """Check all sources of the watched mangas concurrently.
+
+    A manga is yielded as soon as all its sources are checked. When watched on several
+    sources, its chapters are matched by number and the new ones are attributed to
+    the first source to have them.
+    """
+    jobs: list[scraping.ScrapJob] = []
+    for name, sources in watchlist.items():
+        cached = cache.get(name)
+        for source, slug in sources.items():
+            if len(sources) > 1 and cached and not cached.should_check(source):
+                logger.debug("slow-source-skipped", source=source.value, name=name)
+                continue
+            fetch, parse = map_source_scrapers[source]
+            jobs.append(
+                scraping.ScrapJob(
+                    source=source, name=name, fetch=fetch, parse=parse, slug=slug
+                )
+            )
 
-        log = logger.bind(source=source.value)
+    pending = Counter(job.name for job in jobs)
+    checks: dict[str, MangaCheck] = {}
 
-        for name in names:
-            log = log.bind(name=name)
+    results = scraping.iter_scrap(
+        jobs,
+        fetch_workers=CFG.FETCH_WORKERS,
+        parse_workers=CFG.PARSE_WORKERS,
+        cancel=cancel,
+    )
+    for result in results:
+        source, name = MangaSource(result.job.source), result.job.name
+        check = checks.setdefault(
+            name,
+            MangaCheck(name=name, manga=cache.get(name), first_time=name not in cache),
+        )
+        check.elapsed = max(check.elapsed, result.elapsed)
+        racing = len(watchlist[name]) > 1
+
+        if result.error is not None:
+            logger.error(
+                "failed-scrap", source=source.value, name=name, exc_info=result.error
+            )
+            check.errors[source] = result.error
+        elif check.manga is None:
+            check.manga = Manga(name=name, source=source, chapters=result.chapters)
+            if racing:
+                check.manga, _ = check.manga.race(source, result.chapters)
+        elif racing:
+            check.manga, new_chapters = check.manga.race(source, result.chapters)
+            if not check.first_time:
+                check.new_chapters.extend(new_chapters)
+        else:
+            check.new_chapters = check.manga.new_chapters(result.chapters)
+            check.manga = check.manga.merge(result.chapters, source=source)
+
+        if result.error is None:
+            check.checked.append(source)
+
+        pending[name] -= 1
+        if not pending[name]:
+            check.new_chapters.sort(key=lambda x: x.num)
+            yield check
+
+
+def _overdue(manga: Manga | None, now: datetime) -> float:
+    """Seconds a manga is late for its next chapter, going by its recent pace."""
+    if manga is None or manga.n_chapters < 2:
+        return math.inf  # nothing known, check it first
+
+    recent = manga.chapters[-CFG.PACE_WINDOW :]
+    pace = (recent[-1].timestamp - recent[0].timestamp) / (len(recent) - 1)
+    return (now - recent[-1].timestamp - pace).total_seconds()
+
+
+def _prioritize(
+    watchlist: dict[str, dict[MangaSource, str]],
+    cache: dict[str, Manga],
+    cursor: RunCursor,
+) -> dict[str, dict[MangaSource, str]]:
+    """Titles left unchecked by the previous run first, then the most overdue ones."""
+    now = datetime.now(tz=UTC)
+    unchecked = [name for name in cursor.unchecked if name in watchlist]
+    others = sorted(
+        watchlist.keys() - set(unchecked),
+        key=lambda name: _overdue(cache.get(name), now),
+        reverse=True,
+    )
+    return {name: watchlist[name] for name in unchecked + others}
 
-            log.debug("checking-start")
-            try:
-                chapters = scrap_fn(name)
-            except Exception:
-                log.exception("failed-scrap")
-                continue
 
-            if name not in map_name_cache:
-                updated_mangas.append(
-                    Manga(name=name, source=source, chapters=chapters)
-                )
-                log.info("first-time", nchapters=len(chapters))
-                continue
+def iter_new_chapters(
+    map_manga_source: dict[MangaSource, list[str]] | None = None,
+    *,
+    shard: Shard | None = None,
+    cancel: threading.Event | None = None,
+    budget: float | None = None,
+    store: StateStore | None = None,
+    lost: threading.Event | None = None,
+) -> Iterator[MangaCheck]:
+    """Check the watched mangas, yielding each one as soon as it is checked.
+
+    The state is saved once done, or once stopped early (`cancel` set or the generator
+    closed), in which case titles left unchecked keep their known chapters.
+
+    Given a `budget` in seconds, titles are checked by priority and the run stops once
+    it is spent. The titles left are stored in the run cursor, to be checked first by
+    the next run. With CHECKPOINT_EVERY, the state is also saved along the way, and
+    the cursor keeps the new chapters found until they are handed over, so that they
+    are notified even if the run is killed.
+
+    Setting `lost` (the lease of the shard was taken over) stops the run as well, but
+    nothing is saved: the new owner of the shard is the one writing it.
+    """
+    map_manga_source = map_manga_source or get_map_manga_source()
+    watchlist = _get_watchlist(map_manga_source, shard=shard)
+
+    logger.debug("checking-sources", shard=str(shard), nmangas=len(watchlist))
+
+    store = store or get_state_store(shard=shard)
+    mangas = retrieve_cached_mangas(store)
+    if shard is not None and not mangas:
+        # first run of this shard, start from the merged state
+        main_mangas = retrieve_cached_mangas(get_state_store())
+        mangas = [m for m in main_mangas if shard.owns(m.name)]
+    map_name_cache = {m.name: m for m in mangas}
 
-            manga = map_name_cache[name]
-            new_chapters = sorted(
-                set(chapters) - set(manga.chapters), key=lambda x: x.num
+    use_cursor = budget is not None or CFG.CHECKPOINT_EVERY is not None
+    cursor = store.load_cursor() if use_cursor else RunCursor()
+    pending = {n: c for n, c in cursor.pending.items() if n in watchlist}
+    if budget is not None:
+        watchlist = _prioritize(watchlist, map_name_cache, cursor)
+        cancel = cancel or threading.Event()
+        timer = threading.Timer(budget, cancel.set)
+        timer.daemon = True
+        timer.start()
+
+    stop: scraping.CancelFlag | None = cancel
+    if lost is not None:
+        stop = lost if cancel is None else scraping.AnyFlag((cancel, lost))
+
+    updated: dict[str, Manga] = {}
+    checked: set[str] = set()  # by at least one of their sources
+    handed_over: dict[str, list[MangaChapter]] = {}
+
+    def _save(*, final: bool) -> None:
+        if lost is not None and lost.is_set():
+            logger.warning(
+                "lease-lost-discard", shard=str(shard), nupdated=len(updated)
             )
-
-            if not new_chapters:
-                log.debug("nothing-new")
-            else:
-                log.info("new-chapters", nums=[c.num for c in new_chapters])
-                to_notify_map[name] = new_chapters
-
-            updated_mangas.append(
-                Manga(
-                    name=name,
-                    source=source,
-                    chapters=list(set(manga.chapters) | set(chapters)),
-                )
+            return
+        # titles not checked (cancelled, or slow sources skipped) are kept as is
+        updated_mangas = list(updated.values()) + [
+            m
+            for name, m in map_name_cache.items()
+            if name in watchlist and name not in updated
+        ]
+        if CFG.CHAPTER_RETENTION is not None:
+            updated_mangas = compact_mangas(
+                store,
+                updated_mangas,
+                keep=CFG.CHAPTER_RETENTION,
+                archive=CFG.CHAPTER_ARCHIVE,
+            )
+        save_cached_mangas(store, mangas=updated_mangas)
+
+        if use_cursor:
+            unchecked = [name for name in watchlist if name not in checked]
+            # once done, chapters handed over are notified by the caller
+            notifs = pending if final else pending | handed_over
+            store.save_cursor(RunCursor(unchecked=unchecked, pending=notifs))
+            logger.info(
+                "saved-cursor" if final else "checkpoint",
+                nchecked=len(checked),
+                nunchecked=len(unchecked),
             )
 
-    save_cached_mangas(s3client, mangas=updated_mangas)
+    failed = False
+    try:
+        for check in iter_checks(watchlist, map_name_cache, cancel=stop):
+            name = check.name
+            if check.manga is None:  # failed on its first check
+                yield check
+                continue
+
+            # a failing title keeps its known chapters
+            updated[name] = check.manga
+            if check.checked:
+                checked.add(name)
+
+            if name in pending:  # found by an interrupted run
+                recovered = set(pending.pop(name)) | set(check.new_chapters)
+                check.new_chapters = sorted(recovered, key=lambda x: x.num)
+
+            if check.first_time:
+                logger.info("first-time", name=name, nchapters=check.manga.n_chapters)
+            elif check.new_chapters:
+                nums = [c.num for c in check.new_chapters]
+                logger.info("new-chapters", name=name, nums=nums)
+                handed_over[name] = check.new_chapters
+            elif not check.errors:
+                logger.debug("nothing-new", name=name, elapsed=round(check.elapsed, 3))
+
+            if CFG.CHECKPOINT_EVERY and len(updated) % CFG.CHECKPOINT_EVERY == 0:
+                _save(final=False)
+
+            yield check
+    except Exception:
+        failed = True
+        raise
+    finally:
+        if budget is not None:
+            timer.cancel()
+        # chapters handed over are kept pending if the run crashed
+        _save(final=not failed)
 
-    return to_notify_map
+
+def get_new_chapters(
+    map_manga_source: dict[MangaSource, list[str]] | None = None,
+    *,
+    shard: Shard | None = None,
+    budget: float | None = None,
+    store: StateStore | None = None,
+    lost: threading.Event | None = None,
+) -> dict[str, list[MangaChapter]]:
+    checks = iter_new_chapters(
+        map_manga_source, shard=shard, budget=budget, store=store, lost=lost
+    )
+    return {check.name: check.new_chapters for check in checks if check.new_chapters}
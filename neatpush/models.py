@@ -0,0 +1,148 @@
+"""Models of the mangas and their state, shared by the checking and storage modules."""
+
+from __future__ import annotations
+
+import enum
+from collections.abc import Iterable
+from datetime import UTC, datetime
+from typing import Any
+
+from pydantic import BaseModel, field_validator
+
+from neatpush.config import CFG
+from neatpush.scraping import MangaChapter
+
+
+class MangaSource(str, enum.Enum):
+    neatmanga = "neatmanga"
+    mangapill = "mangapill"
+    toonily = "toonily"
+
+
+class SourceStats(BaseModel):
+    """How fast a source publishes the chapters of a manga watched on several ones."""
+
+    leads: int = 0  # chapters first seen on this source
+    lags: int = 0  # chapters seen on this source after another one
+    lag_seconds: float = 0.0
+    # Highest chapter number seen on this source, unset until its first check
+    last_num: float | None = None
+    skipped: int = 0  # checks skipped in a row since it is slow
+
+    @property
+    def is_slow(self) -> bool:
+        samples = self.leads + self.lags
+        return (
+            samples >= CFG.RACE_MIN_SAMPLES
+            and self.leads / samples < CFG.RACE_SLOW_LEAD_RATIO
+        )
+
+
+class Manga(BaseModel):
+    name: str
+    source: MangaSource
+    chapters: list[MangaChapter]
+
+    # High-water mark of the chapters moved out of `chapters` by a compaction,
+    # anything up to this number is known.
+    archived_up_to: float | None = None
+
+    # Only filled for mangas watched on several sources
+    source_stats: dict[MangaSource, SourceStats] = {}
+
+    @property
+    def n_chapters(self) -> int:
+        return len(self.chapters)
+
+    def new_chapters(self, chapters: Iterable[MangaChapter]) -> list[MangaChapter]:
+        """Chapters not known yet, matched by number as urls differ across sources."""
+        known_nums = {c.num for c in self.chapters}
+        new: dict[float, MangaChapter] = {}
+        for c in sorted(set(chapters) - set(self.chapters), key=lambda x: x.url):
+            if c.num in known_nums or c.num in new:
+                continue
+            if self.archived_up_to is None or c.num > self.archived_up_to:
+                new[c.num] = c
+        return sorted(new.values(), key=lambda x: x.num)
+
+    def merge(self, chapters: Iterable[MangaChapter], **update: Any) -> Manga:
+        merged = sorted(
+            self.chapters + self.new_chapters(chapters), key=lambda x: x.num
+        )
+        return self.model_copy(update={"chapters": merged, **update})
+
+    def race(
+        self,
+        source: MangaSource,
+        chapters: Iterable[MangaChapter],
+        *,
+        now: datetime | None = None,
+    ) -> tuple[Manga, list[MangaChapter]]:
+        """Merge the chapters seen on `source`, returning the ones it is first to have.
+
+        Chapters already known from another source are the ones `source` lags behind,
+        by the time elapsed since they were published there.
+        """
+        now = now or datetime.now(tz=UTC)
+        chapters = list(chapters)
+        new_chapters = self.new_chapters(chapters)
+
+        stats = self.source_stats.get(source, SourceStats()).model_copy()
+        stats.skipped = 0
+        if stats.last_num is not None:  # nothing to compare to on the first check
+            last_num = stats.last_num
+            known = {c.num: c for c in self.chapters}
+            lagged = {
+                known[c.num] for c in chapters if c.num > last_num and c.num in known
+            }
+            stats.leads += len(new_chapters)
+            stats.lags += len(lagged)
+            stats.lag_seconds += sum(
+                max((now - c.timestamp).total_seconds(), 0) for c in lagged
+            )
+        stats.last_num = max((c.num for c in chapters), default=stats.last_num)
+
+        manga = self.merge(new_chapters)
+        manga.source_stats = {**self.source_stats, source: stats}
+        return manga, new_chapters
+
+    def should_check(self, source: MangaSource) -> bool:
+        """Whether to check a source of a raced manga, counting the skipped checks."""
+        stats = self.source_stats.get(source)
+        if stats is None or not stats.is_slow:
+            return True
+        if stats.skipped + 1 >= CFG.RACE_SLOW_POLL_EVERY:
+            return True
+        stats.skipped += 1
+        return False
+
+    def compact(self, keep: int) -> tuple[Manga, list[MangaChapter]]:
+        """Keep the last `keep` chapters, returning the compacted ones."""
+        if self.n_chapters <= keep:
+            return self, []
+
+        idx = self.n_chapters - keep
+        archived, kept = self.chapters[:idx], self.chapters[idx:]
+        archived_up_to = max(archived[-1].num, self.archived_up_to or archived[-1].num)
+        manga = self.model_copy(
+            update={"chapters": kept, "archived_up_to": archived_up_to}
+        )
+        return manga, archived
+
+    @field_validator("chapters")
+    @classmethod
+    def _sort_chapters(cls, values: list[MangaChapter]) -> list[MangaChapter]:
+        return sorted(values, key=lambda x: x.num)
+
+    def __repr__(self) -> str:
+        return f"<Manga {self.name} - {self.source}> #{self.n_chapters} chapters"
+
+    __str__ = __repr__
+
+
+class RunCursor(BaseModel):
+    """Progress of a budgeted or checkpointed run, for the next one to resume."""
+
+    unchecked: list[str] = []
+    # New chapters found by an interrupted run, not notified yet
+    pending: dict[str, list[MangaChapter]] = {}
@@ -1,16 +1,22 @@
 from __future__ import annotations
 
+import functools
 import hashlib
 import hmac
 import mimetypes
 import re
+import statistics
+import time
 from binascii import hexlify
+from collections import deque
 from collections.abc import Generator
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from datetime import UTC, datetime
 from functools import reduce
 from pathlib import Path
 from typing import Annotated, Any, ClassVar, Literal, overload
 from urllib.parse import quote as url_quote
+from xml.etree import ElementTree
 
 import httpx
 import tenacity
@@ -232,6 +238,59 @@ class AWSv4Auth(BaseModel, httpx.Auth):
         yield request
 
 
+class RetryPolicy(BaseModel):
+    """Retries of S3 requests, with exponential jittered backoff and a total deadline."""
+
+    max_attempts: int = 5
+    backoff: float = 0.2  # multiplier of the exponential backoff, in seconds
+    max_backoff: float = 5.0
+    deadline: float = 30.0  # total time spent retrying, in seconds
+
+    # 5xx errors, and throttling (429, 503 "SlowDown")
+    retry_statuses: frozenset[int] = frozenset({429, 500, 502, 503, 504})
+
+    def _should_retry_response(self, resp: httpx.Response) -> bool:
+        return resp.status_code in self.retry_statuses
+
+    @staticmethod
+    def _should_retry_exception(exc: BaseException) -> bool:
+        # disconnects, timeouts & other network errors
+        return isinstance(exc, httpx.TransportError)
+
+    def retrying(self) -> tenacity.Retrying:
+        return tenacity.Retrying(
+            stop=(
+                tenacity.stop_after_attempt(self.max_attempts)
+                | tenacity.stop_after_delay(self.deadline)
+            ),
+            wait=tenacity.wait_random_exponential(
+                multiplier=self.backoff, max=self.max_backoff
+            ),
+            retry=(
+                tenacity.retry_if_exception(self._should_retry_exception)
+                | tenacity.retry_if_result(self._should_retry_response)
+            ),
+            # once exhausted, return the last response or raise the last error
+            retry_error_callback=lambda state: state.outcome.result(),  # type: ignore[union-attr]
+        )
+
+
+class _Latencies:
+    """Sliding window of latencies, to derive the delay of hedged requests."""
+
+    def __init__(self, size: int = 100, min_samples: int = 20) -> None:
+        self.values: deque[float] = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def add(self, value: float) -> None:
+        self.values.append(value)
+
+    def p95(self) -> float | None:
+        if len(self.values) < self.min_samples:
+            return None
+        return statistics.quantiles(self.values, n=20)[-1]
+
+
 class S3Client:
     def __init__(
         self,
@@ -241,8 +300,24 @@ class S3Client:
         base_url: str,
         region: str,
         client: httpx.Client | None = None,
+        *,
+        retry_policy: RetryPolicy | None = None,
+        hedge_gets: bool = False,
+        hedge_delay: float = 1.0,
     ) -> None:
+        """
+        Args:
+            retry_policy: retries of failing requests.
+            hedge_gets: send a second identical GET request when the first one is
+                slower than the p95 of the previous ones, and use the fastest.
+            hedge_delay: delay before hedging until enough latencies are known.
+        """
         self.bucket = bucket
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.hedge_gets = hedge_gets
+        self.hedge_delay = hedge_delay
+        self._get_latencies = _Latencies()
+        self._hedger: ThreadPoolExecutor | None = None
 
         auth = AWSv4Auth(
             access_key=access_key,
@@ -255,24 +330,38 @@ class S3Client:
             auth=auth,
             timeout=httpx.Timeout(timeout=10, connect=3),
             limits=httpx.Limits(max_connections=64),
-            transport=httpx.HTTPTransport(retries=5),
         )
 
-        # add retries capabilities:
-        self.http.request = tenacity.retry(  # type: ignore[method-assign]
-            stop=tenacity.stop_after_attempt(5),
-            retry=tenacity.retry_if_exception(
-                lambda x: isinstance(x, S3RequestError) and x.status == 500
-            ),
-        )(self.http.request)
-
-        self.http.request = tenacity.retry(  # type: ignore[method-assign]
-            stop=tenacity.stop_after_attempt(5),
-            retry=tenacity.retry_if_exception(
-                lambda x: isinstance(x, httpx.RemoteProtocolError)
-                and "Server disconnected without sending a response." == str(x)
-            ),
-        )(self.http.request)
+    def _timed_get(self, endpoint: str) -> httpx.Response:
+        start = time.perf_counter()
+        resp = self.http.request("GET", endpoint)
+        self._get_latencies.add(time.perf_counter() - start)
+        return resp
+
+    def _hedged_get(self, endpoint: str) -> httpx.Response:
+        if self._hedger is None:
+            self._hedger = ThreadPoolExecutor(8, thread_name_prefix="s3-hedge")
+
+        delay = self._get_latencies.p95() or self.hedge_delay
+        futures = [self._hedger.submit(self._timed_get, endpoint)]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            futures.append(self._hedger.submit(self._timed_get, endpoint))
+
+        # the first successful response wins, errors only surface if both failed
+        for fut in as_completed(futures):
+            if fut.exception() is None:
+                return fut.result()
+        return futures[0].result()
+
+    def request(
+        self, method: HttpMethodT, endpoint: str, **kwargs: Any
+    ) -> httpx.Response:
+        if method == "GET" and self.hedge_gets and not kwargs:
+            send = functools.partial(self._hedged_get, endpoint)
+        else:
+            send = functools.partial(self.http.request, method, endpoint, **kwargs)
+        return self.retry_policy.retrying()(send)
 
     def upload(
         self,
@@ -303,7 +392,8 @@ class S3Client:
         if is_public:
             headers[_ACL_HEADER] = "public-read"
 
-        r = self.http.put(
+        r = self.request(
+            "PUT",
             endpoint,
             content=content,
             headers=headers,
@@ -318,10 +408,38 @@ class S3Client:
         filepath = _sanitize_path(filepath)
         endpoint = f"{self.bucket}/{url_quote(filepath)}"
 
-        resp = self.http.get(endpoint)
+        resp = self.request("GET", endpoint)
         if resp.status_code == 404:
             raise S3FileDoesNotExist(filepath)
 
         resp.raise_for_status()
 
         return resp.content
+
+    def list(self, prefix: str | Path = "") -> list[S3File]:
+        params = {"list-type": "2", "prefix": _sanitize_path(prefix)}
+
+        files: list[S3File] = []
+        while True:
+            resp = self.request("GET", self.bucket, params=params)
+            if resp.status_code != 200:
+                raise S3RequestError(resp)
+
+            root = ElementTree.fromstring(xmlns_pattern.sub(b"", resp.content))  # noqa: S314
+            files.extend(
+                S3File.model_validate({e.tag: e.text for e in content})
+                for content in root.iter("Contents")
+            )
+
+            token = root.findtext("NextContinuationToken")
+            if root.findtext("IsTruncated") != "true" or not token:
+                return files
+            params["continuation-token"] = token
+
+    def delete(self, filepath: str | Path) -> None:
+        filepath = _sanitize_path(filepath)
+        endpoint = f"{self.bucket}/{url_quote(filepath)}"
+
+        resp = self.request("DELETE", endpoint)
+        if resp.status_code not in (200, 204):
+            raise S3RequestError(resp)
@@ -1,7 +1,19 @@
+import multiprocessing
 import re
+import time
 import warnings
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
 from dataclasses import dataclass, field
 from datetime import UTC, datetime
+from typing import Any, Protocol
 
 import bs4
 import dateparser
@@ -9,6 +21,8 @@ import httpx
 import pytz
 import structlog
 
+from neatpush.config import CFG
+
 Soup = bs4.BeautifulSoup
 
 warnings.filterwarnings(action="ignore", category=bs4.GuessedAtParserWarning)
@@ -18,6 +32,22 @@ tz = pytz.timezone("Europe/Brussels")
 logger = structlog.getLogger(__name__)
 
 
+class CancelFlag(Protocol):
+    """Anything telling whether to stop, such as a `threading.Event`."""
+
+    def is_set(self) -> bool: ...
+
+
+@dataclass(frozen=True)
+class AnyFlag:
+    """Set as soon as one of `flags` is."""
+
+    flags: tuple[CancelFlag, ...]
+
+    def is_set(self) -> bool:
+        return any(flag.is_set() for flag in self.flags)
+
+
 class ScrapingError(Exception):
     pass
 
@@ -47,24 +77,38 @@ class MangaChapter:
 PATTERN_NUM = re.compile(r"\d+\.?\d*")
 
 
-def scrap_neatmanga(name: str) -> set[MangaChapter]:
-    url = f"https://neatmanga.com/manga/{name}/ajax/chapters"
-    resp = httpx.post(url, follow_redirects=True)
+def _fetch_madara(method: str, url: str, name: str) -> str:
+    resp = httpx.request(method, url, follow_redirects=True)
 
     if resp.status_code == 404:
         raise MangaNotFound(name)
     elif not resp.is_success:
         raise ScrapingError(f"Failed to scrap {name}: {resp.text}")
 
-    resp.raise_for_status()
-    soup = Soup(resp.text)
+    if "wp-manga-chapter" not in resp.text:
+        raise ScrapingError(f"Found no chapters for {name} at {url}")
+    return resp.text
+
+
+def fetch_neatmanga(name: str) -> str:
+    # chapters list fragment of the Madara theme, much lighter than the manga page
+    url = f"{CFG.NEATMANGA_URL}/manga/{name}/ajax/chapters"
+    return _fetch_madara("POST", url, name)
+
+
+def fetch_neatmanga_page(name: str) -> str:
+    return _fetch_madara("GET", f"{CFG.NEATMANGA_URL}/manga/{name}/", name)
+
+
+def parse_neatmanga(html: str) -> list[MangaChapter]:
+    soup = Soup(html)
 
     raw = soup.find_all("li", attrs={"class": "wp-manga-chapter"})
 
     results: list[MangaChapter] = []
     for e in raw:
         timestamp = dateparser.parse(e.find("i").text)
-        assert timestamp, f"Could not find timestamp for {name} on {e}"
+        assert timestamp, f"Could not find timestamp on {e}"
 
         a = e.find("a")
 
@@ -82,28 +126,34 @@ def scrap_neatmanga(name: str) -> set[MangaChapter]:
             )
         )
 
-    return set(results)
+    return results
 
 
-def scrap_mangapill(name: str) -> set[MangaChapter]:
-    base_url = "https://mangapill.com"
-    search_url = f"{base_url}/quick-search"
+def scrap_neatmanga(name: str) -> set[MangaChapter]:
+    return set(parse_neatmanga(fetch_neatmanga(name)))
+
+
+def fetch_mangapill(name: str) -> str:
+    search_url = f"{CFG.MANGAPILL_URL}/quick-search"
     search_resp = httpx.get(search_url, params={"q": name})
 
     search_soup = Soup(search_resp.text)
     endpoint = search_soup.find("a").attrs["href"]  # type: ignore
 
-    url = f"{base_url}{endpoint}"
+    url = f"{CFG.MANGAPILL_URL}{endpoint}"
     resp = httpx.get(url)
+    return resp.text
+
 
-    soup = Soup(resp.text)
+def parse_mangapill(html: str) -> list[MangaChapter]:
+    soup = Soup(html)
     pattern = re.compile("^/chapters")
     raw = soup.find_all("a", attrs={"href": pattern})
 
     chapters: list[MangaChapter] = []
     for e in raw:
         endpoint = e.attrs["href"]
-        url = f"{base_url}{endpoint}"
+        url = f"{CFG.MANGAPILL_URL}{endpoint}"
 
         match = PATTERN_NUM.search(e.text)
         if match:
@@ -119,17 +169,26 @@ def scrap_mangapill(name: str) -> set[MangaChapter]:
             )
         )
 
-    return set(chapters)
+    return chapters
 
 
-def scrap_toonily(name: str) -> set[MangaChapter]:
-    url = f"https://toonily.net/manga/{name}/"
-    resp = httpx.get(url)
+def scrap_mangapill(name: str) -> set[MangaChapter]:
+    return set(parse_mangapill(fetch_mangapill(name)))
+
+
+def fetch_toonily(name: str) -> str:
+    return _fetch_madara("GET", f"{CFG.TOONILY_URL}/manga/{name}/", name)
+
+
+def fetch_toonily_ajax(name: str) -> str:
+    return _fetch_madara("POST", f"{CFG.TOONILY_URL}/manga/{name}/ajax/chapters/", name)
+
 
-    soup = Soup(resp.text)
+def parse_toonily(html: str) -> list[MangaChapter]:
+    soup = Soup(html)
     raw = soup.find_all("li", attrs={"class": "wp-manga-chapter"})
 
-    pattern = re.compile(f"^{url}")
+    pattern = re.compile(f"^{CFG.TOONILY_URL}/manga/")
     results: list[MangaChapter] = []
     for e in raw:
         a = e.find("a", attrs={"href": pattern})
@@ -147,7 +206,7 @@ def scrap_toonily(name: str) -> set[MangaChapter]:
             soup_timestamp = e.find_all("a")[-1].attrs["title"]
 
         timestamp = dateparser.parse(soup_timestamp)
-        assert timestamp, f"Failed to find timestamp for {name} on toonily"
+        assert timestamp, f"Failed to find timestamp on {e}"
 
         results.append(
             MangaChapter(
@@ -157,6 +216,175 @@ def scrap_toonily(name: str) -> set[MangaChapter]:
             )
         )
 
-    assert results, f"Found no chapters for {name}"
+    assert results, "Found no chapters on toonily"
+
+    return results
+
+
+def scrap_toonily(name: str) -> set[MangaChapter]:
+    return set(parse_toonily(fetch_toonily(name)))
+
+
+# -- Pipeline
+
+
+type FetchFn = Callable[[str], str]
+type ParseFn = Callable[[str], list[MangaChapter]]
+
+
+# -- Fetch strategies
+
+# Ways of fetching the chapters list of each site, cheapest first. Mangapill has no
+# lighter endpoint than its manga page.
+FETCH_STRATEGIES: dict[str, list[tuple[str, FetchFn]]] = {
+    "neatmanga": [("ajax", fetch_neatmanga), ("page", fetch_neatmanga_page)],
+    "mangapill": [("page", fetch_mangapill)],
+    "toonily": [("ajax", fetch_toonily_ajax), ("page", fetch_toonily)],
+}
+
+# site -> (strategy that last worked, when it started working), remembered for the
+# lifetime of the process only: a new process pays at most one failed fetch per site
+_working_strategies: dict[str, tuple[str, float]] = {}
+
+
+def fetch_with_fallback(site: str) -> FetchFn:
+    """Fetch through the strategy of `site` known to work, or the cheapest one.
+
+    Strategies are tried in order until one succeeds, which is then used first for
+    FETCH_STRATEGY_TTL seconds before giving the cheaper ones another chance. A missing
+    manga is missing whatever the strategy, so `MangaNotFound` is raised right away.
+    """
+    strategies = FETCH_STRATEGIES[site]
 
-    return set(results)
+    def fetch(name: str) -> str:
+        working, since = _working_strategies.get(site, (None, 0.0))
+        if time.monotonic() - since > CFG.FETCH_STRATEGY_TTL:
+            working = None
+        ordered = sorted(strategies, key=lambda s: s[0] != working)
+
+        error: Exception | None = None
+        for strategy, fn in ordered:
+            try:
+                html = fn(name)
+            except MangaNotFound:
+                raise
+            except Exception as exc:
+                logger.warning(
+                    "fetch-strategy-failed",
+                    site=site,
+                    strategy=strategy,
+                    name=name,
+                    error=str(exc),
+                )
+                error = exc
+                continue
+
+            if strategy != working:
+                logger.info("fetch-strategy", site=site, strategy=strategy)
+                _working_strategies[site] = (strategy, time.monotonic())
+            return html
+
+        assert error is not None
+        raise error
+
+    return fetch
+
+
+@dataclass(frozen=True)
+class ScrapJob:
+    source: str
+    name: str
+    fetch: FetchFn
+    parse: ParseFn  # sent to the parsing processes, hence a module level function
+    slug: str | None = None  # when the source does not use `name` in its urls
+
+
+@dataclass(frozen=True)
+class ScrapResult:
+    job: ScrapJob
+    chapters: list[MangaChapter]
+    error: Exception | None = None
+    elapsed: float = 0.0
+
+
+_parse_pool: tuple[int, ProcessPoolExecutor] | None = None
+
+
+def _get_parse_pool(workers: int) -> ProcessPoolExecutor:
+    # The pool is kept alive in between runs, spawning it imports bs4 & dateparser
+    global _parse_pool
+    if _parse_pool is None or _parse_pool[0] != workers:
+        if _parse_pool is not None:
+            _parse_pool[1].shutdown(wait=False)
+        ctx = multiprocessing.get_context("spawn")  # fork is unsafe with threads
+        _parse_pool = (workers, ProcessPoolExecutor(workers, mp_context=ctx))
+    return _parse_pool[1]
+
+
+def _discard_parse_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a broken pool (e.g. a worker died), for the next one to be spawned."""
+    global _parse_pool
+    if _parse_pool is not None and _parse_pool[1] is pool:
+        logger.warning("broken-parse-pool")
+        pool.shutdown(wait=False, cancel_futures=True)
+        _parse_pool = None
+
+
+def _fetch(job: ScrapJob, parse: bool) -> str | list[MangaChapter]:
+    html = job.fetch(job.slug or job.name)
+    return job.parse(html) if parse else html
+
+
+def iter_scrap(
+    jobs: Iterable[ScrapJob],
+    *,
+    fetch_workers: int = 8,
+    parse_workers: int = 0,
+    cancel: CancelFlag | None = None,
+) -> Iterator[ScrapResult]:
+    """Scrap all jobs, yielding results as soon as they are available.
+
+    Pages are fetched concurrently in threads. When `parse_workers` is set, the raw
+    html is handed over to a process pool for parsing while fetching goes on,
+    otherwise it is parsed in the fetching thread.
+
+    Setting `cancel` stops the scraping shortly, dropping the jobs still pending.
+    """
+    pool = _get_parse_pool(parse_workers) if parse_workers > 0 else None
+    fetchers = ThreadPoolExecutor(fetch_workers, thread_name_prefix="neatpush-fetch")
+
+    # future -> (job, submission time, parsing pool if it is the parsing stage)
+    pending: dict[Future[Any], tuple[ScrapJob, float, ProcessPoolExecutor | None]] = {
+        fetchers.submit(_fetch, job, pool is None): (job, time.perf_counter(), None)
+        for job in jobs
+    }
+
+    try:
+        while pending:
+            if cancel is not None and cancel.is_set():
+                logger.info("scrap-cancelled", npending=len(pending))
+                return
+            done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for fut in done:
+                job, started, parser = pending.pop(fut)
+                try:
+                    payload = fut.result()
+                    if pool is not None and parser is None:
+                        pending[pool.submit(job.parse, payload)] = (job, started, pool)
+                        continue
+                except Exception as exc:
+                    if isinstance(exc, BrokenProcessPool) and pool is not None:
+                        # only this job is lost, later ones go to a new pool
+                        _discard_parse_pool(parser or pool)
+                        pool = _get_parse_pool(parse_workers)
+                    elapsed = time.perf_counter() - started
+                    yield ScrapResult(job=job, chapters=[], error=exc, elapsed=elapsed)
+                    continue
+
+                assert isinstance(payload, list)
+                elapsed = time.perf_counter() - started
+                yield ScrapResult(job=job, chapters=payload, elapsed=elapsed)
+    finally:
+        for fut in pending:
+            fut.cancel()
+        fetchers.shutdown(wait=False, cancel_futures=True)
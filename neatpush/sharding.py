@@ -0,0 +1,284 @@
+"""Horizontal sharding of the watchlist across workers.
+
+Titles are partitioned in `count` shards by a stable hash of their name. A worker
+running a shard only reads and writes the state of that shard, and stores the new
+chapters it found in the bucket instead of notifying. A final merge step gathers
+all shards into the main state and sends a single notification.
+
+Workers can either be assigned a shard (`neatpush run --shard i/N`), or claim them
+through lease objects in the bucket (`neatpush run --lease`).
+"""
+
+from __future__ import annotations
+
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+from pathlib import PurePosixPath
+
+import orjson
+import structlog
+from pydantic import BaseModel, TypeAdapter
+
+from neatpush.config import CFG
+from neatpush.s3 import S3Client, S3FileDoesNotExist
+from neatpush.scraping import MangaChapter
+
+logger = structlog.getLogger(__name__)
+
+_notifs_adapter = TypeAdapter(dict[str, list[MangaChapter]])
+
+
+@dataclass(frozen=True)
+class Shard:
+    index: int
+    count: int
+
+    def __post_init__(self) -> None:
+        if not 0 <= self.index < self.count:
+            raise ValueError(f"Invalid shard {self.index}/{self.count}")
+
+    @classmethod
+    def parse(cls, value: str) -> Shard:
+        """Parse a shard written as 'i/N'."""
+        try:
+            index, count = (int(e) for e in value.split("/"))
+        except ValueError as exc:
+            raise ValueError(f"Invalid shard '{value}', expected 'i/N'") from exc
+        return cls(index=index, count=count)
+
+    @classmethod
+    def all(cls, count: int) -> list[Shard]:
+        return [cls(index=i, count=count) for i in range(count)]
+
+    def owns(self, name: str) -> bool:
+        # crc32 is stable across processes, contrary to hash()
+        return zlib.crc32(name.encode()) % self.count == self.index
+
+    def key(self, key: str | os.PathLike[str], kind: str = "") -> str:
+        """Derive the shard specific key of a state key (or path)."""
+        path = PurePosixPath(os.fspath(key))
+        kind = f".{kind}" if kind else ""
+        return str(
+            path.with_name(
+                f"{path.stem}.shard-{self.index}-of-{self.count}{kind}{path.suffix}"
+            )
+        )
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+
+# -- Notifications
+
+
+def _notifs_prefix(shard: Shard) -> str:
+    return str(PurePosixPath(shard.key(CFG.BUCKET_KEY, kind="notifs")).with_suffix(""))
+
+
+def save_shard_notifs(
+    s3client: S3Client, shard: Shard, notifs: dict[str, list[MangaChapter]]
+) -> str:
+    """Store new chapters of a shard, for the merge step to notify them.
+
+    Each run writes its own object, so that nothing is lost if a merge happens
+    concurrently: the merge only deletes the objects it did notify.
+    """
+    now = datetime.now(tz=UTC).strftime("%Y%m%dT%H%M%S")
+    key = f"{_notifs_prefix(shard)}/{now}-{uuid.uuid4().hex[:8]}.json"
+    s3client.upload(key, orjson.dumps(notifs))
+    return key
+
+
+def load_shard_notifs(
+    s3client: S3Client, shard: Shard
+) -> tuple[list[str], dict[str, list[MangaChapter]]]:
+    """Gather the pending notifications of a shard, and the keys they come from."""
+    keys = [f.key for f in s3client.list(f"{_notifs_prefix(shard)}/")]
+
+    notifs: dict[str, set[MangaChapter]] = {}
+    for key in keys:
+        content = s3client.download(key)
+        for name, chapters in _notifs_adapter.validate_json(content).items():
+            notifs.setdefault(name, set()).update(chapters)
+
+    return keys, {
+        name: sorted(chapters, key=lambda x: x.num) for name, chapters in notifs.items()
+    }
+
+
+def merge_shards(
+    count: int,
+    notify: Callable[[dict[str, list[MangaChapter]]], object],
+) -> dict[str, list[MangaChapter]]:
+    """Merge the shards states into the main state, and notify their new chapters."""
+    from neatpush.manga import _get_s3_client, get_state_store
+
+    s3client = _get_s3_client()
+    main_store = get_state_store()
+    main_mangas = main_store.load()
+
+    merged = []
+    merged_keys: list[str] = []
+    to_notify: dict[str, list[MangaChapter]] = {}
+    for shard in Shard.all(count):
+        shard_mangas = get_state_store(shard=shard).load()
+        if not shard_mangas:
+            # the shard never ran, keep what is known about its titles
+            shard_mangas = [m for m in main_mangas if shard.owns(m.name)]
+        merged.extend(shard_mangas)
+
+        keys, notifs = load_shard_notifs(s3client, shard)
+        merged_keys.extend(keys)
+        to_notify |= notifs
+
+    main_store.save(merged)
+    logger.info("merged-shards", nshards=count, nmangas=len(merged))
+
+    if to_notify:
+        notify(to_notify)
+
+    # only dropped once notified, so that a failing merge is retried next time
+    for key in merged_keys:
+        s3client.delete(key)
+
+    return to_notify
+
+
+# -- Leases
+
+
+class Lease(BaseModel):
+    owner: str
+    expires_at: datetime
+
+    @property
+    def is_expired(self) -> bool:
+        return self.expires_at <= datetime.now(tz=UTC)
+
+
+def _default_owner() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class LeaseManager:
+    """Claim shards through lease objects stored in the bucket.
+
+    S3 offers no compare-and-swap, so a lease is written and then read back after
+    `settle` seconds to detect a concurrent claim: the last writer wins.
+    """
+
+    def __init__(
+        self,
+        s3client: S3Client,
+        *,
+        owner: str | None = None,
+        ttl: float = 300,
+        settle: float = 1.0,
+    ) -> None:
+        self.s3client = s3client
+        self.owner = owner or _default_owner()
+        self.ttl = ttl
+        self.settle = settle
+
+    def _key(self, shard: Shard) -> str:
+        return shard.key(CFG.BUCKET_KEY, kind="lease")
+
+    def get(self, shard: Shard) -> Lease | None:
+        try:
+            content = self.s3client.download(self._key(shard))
+        except S3FileDoesNotExist:
+            return None
+        return Lease.model_validate_json(content)
+
+    def _write(self, shard: Shard) -> None:
+        expires_at = datetime.now(tz=UTC) + timedelta(seconds=self.ttl)
+        lease = Lease(owner=self.owner, expires_at=expires_at)
+        self.s3client.upload(self._key(shard), lease.model_dump_json().encode())
+
+    def acquire(self, shard: Shard) -> bool:
+        lease = self.get(shard)
+        if lease and lease.owner != self.owner and not lease.is_expired:
+            return False
+
+        self._write(shard)
+        time.sleep(self.settle)
+
+        lease = self.get(shard)
+        return lease is not None and lease.owner == self.owner
+
+    def renew(self, shard: Shard) -> bool:
+        lease = self.get(shard)
+        if lease is None or lease.owner != self.owner:
+            logger.warning("lease-lost", shard=str(shard), owner=self.owner)
+            return False
+        self._write(shard)
+        return True
+
+    def release(self, shard: Shard) -> None:
+        lease = self.get(shard)
+        if lease is not None and lease.owner == self.owner:
+            self.s3client.delete(self._key(shard))
+
+    @contextmanager
+    def hold(self, shard: Shard) -> Iterator[threading.Event]:
+        """Keep renewing the lease of an acquired shard until exiting.
+
+        The event yielded is set if the lease is lost meanwhile, i.e. taken over by
+        another worker after failing to renew it in time. Once done, the lease is renewed one last time and left to expire so that other
+        workers do not process the shard again in the same cycle. It is released right
+        away on failure for another worker to take over.
+        """
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def _renew() -> None:
+            while not stop.wait(self.ttl / 3):
+                if not self.renew(shard):
+                    lost.set()
+                    return
+
+        renewer = threading.Thread(target=_renew, daemon=True)
+        renewer.start()
+        succeeded = False
+        try:
+            yield lost
+            succeeded = True
+        finally:
+            stop.set()
+            renewer.join()
+            if not succeeded:
+                self.release(shard)
+            elif not lost.is_set():  # otherwise owned by another worker now
+                self.renew(shard)
+
+    def claim_shards(
+        self, count: int, *, deadline: float | None = None
+    ) -> Iterator[tuple[Shard, threading.Event]]:
+        """Yield the shards successively claimed by this worker, while holding them.
+
+        Each shard comes with the event set if its lease is lost, see `hold`.
+
+        No more shards are claimed past `deadline` (a `time.monotonic` value).
+        """
+        shards = Shard.all(count)
+        # start at a worker specific offset to limit contention
+        offset = zlib.crc32(self.owner.encode()) % count
+        for shard in shards[offset:] + shards[:offset]:
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.info("claim-deadline", owner=self.owner)
+                return
+            if not self.acquire(shard):
+                logger.debug("lease-taken", shard=str(shard))
+                continue
+
+            logger.info("lease-acquired", shard=str(shard), owner=self.owner)
+            with self.hold(shard) as lost:
+                yield shard, lost
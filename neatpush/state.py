@@ -0,0 +1,389 @@
+from __future__ import annotations
+
+import abc
+import sqlite3
+import threading
+from collections.abc import Iterable
+from datetime import datetime
+from pathlib import Path, PurePosixPath
+
+import orjson
+import structlog
+from pydantic import TypeAdapter
+
+from neatpush.models import Manga, RunCursor
+from neatpush.s3 import S3Client, S3FileDoesNotExist
+from neatpush.scraping import MangaChapter
+
+logger = structlog.getLogger(__name__)
+
+_chapters_adapter = TypeAdapter(list[MangaChapter])
+
+
+class StateStore(abc.ABC):
+    """Persistence of the known mangas and their chapters."""
+
+    name: str
+
+    @abc.abstractmethod
+    def load(self) -> list[Manga]: ...
+
+    @abc.abstractmethod
+    def save(self, mangas: list[Manga]) -> None:
+        """Replace the whole state with `mangas`."""
+
+    @abc.abstractmethod
+    def archive(self, name: str, chapters: Iterable[MangaChapter]) -> None:
+        """Move compacted chapters of a manga to cold storage."""
+
+    @abc.abstractmethod
+    def load_archive(self, name: str) -> list[MangaChapter]: ...
+
+    @abc.abstractmethod
+    def load_cursor(self) -> RunCursor: ...
+
+    @abc.abstractmethod
+    def save_cursor(self, cursor: RunCursor) -> None: ...
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {self.name}>"
+
+
+class S3StateStore(StateStore):
+    """Whole state stored as a single JSON object in the bucket.
+
+    A missing object raises `S3FileDoesNotExist`, unless `allow_missing` in which case
+    the state starts empty (e.g. a misconfigured key would otherwise be overwritten).
+    """
+
+    def __init__(
+        self, s3client: S3Client, key: str, *, allow_missing: bool = False
+    ) -> None:
+        self.s3client = s3client
+        self.key = key
+        self.allow_missing = allow_missing
+        self.name = f"s3://{s3client.bucket}/{key}"
+
+    def load(self) -> list[Manga]:
+        try:
+            content = self.s3client.download(self.key)
+        except S3FileDoesNotExist:
+            if not self.allow_missing:
+                raise
+            logger.warning("empty-state", store=self.name)
+            return []
+        return [Manga(**e) for e in orjson.loads(content)]
+
+    def save(self, mangas: list[Manga]) -> None:
+        content = orjson.dumps([m.model_dump() for m in mangas])
+        self.s3client.upload(self.key, content, is_public=True)
+
+    def _archive_key(self, name: str) -> str:
+        path = PurePosixPath(self.key)
+        return str(path.with_name(f"{path.stem}.archive") / f"{name}{path.suffix}")
+
+    def load_archive(self, name: str) -> list[MangaChapter]:
+        try:
+            content = self.s3client.download(self._archive_key(name))
+        except S3FileDoesNotExist:
+            return []
+        return _chapters_adapter.validate_json(content)
+
+    def archive(self, name: str, chapters: Iterable[MangaChapter]) -> None:
+        archived = set(self.load_archive(name)) | set(chapters)
+        content = orjson.dumps(sorted(archived, key=lambda x: x.num))
+        self.s3client.upload(self._archive_key(name), content)
+
+    def _cursor_key(self) -> str:
+        path = PurePosixPath(self.key)
+        return str(path.with_name(f"{path.stem}.cursor{path.suffix}"))
+
+    def load_cursor(self) -> RunCursor:
+        try:
+            content = self.s3client.download(self._cursor_key())
+        except S3FileDoesNotExist:
+            return RunCursor()
+        return RunCursor.model_validate_json(content)
+
+    def save_cursor(self, cursor: RunCursor) -> None:
+        self.s3client.upload(self._cursor_key(), cursor.model_dump_json().encode())
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS mangas (
+    name TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    archived_up_to REAL,
+    source_stats TEXT
+);
+CREATE TABLE IF NOT EXISTS chapters (
+    manga TEXT NOT NULL REFERENCES mangas (name) ON DELETE CASCADE,
+    url TEXT NOT NULL,
+    num REAL NOT NULL,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (manga, url)
+);
+CREATE TABLE IF NOT EXISTS run_cursor (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    content TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS archived_chapters (
+    manga TEXT NOT NULL,
+    url TEXT NOT NULL,
+    num REAL NOT NULL,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (manga, url)
+);
+"""
+
+
+class SQLiteStateStore(StateStore):
+    """Local state, one row per chapter indexed on (manga, chapter url).
+
+    Contrary to the S3 store, saving only touches the rows that changed. Both loading
+    and saving read each table once, whatever the number of mangas.
+
+    The connection is shared by threads (e.g. the flusher of a `MemoryStateStore`),
+    so loads and saves are serialized: a load would see a save in progress otherwise.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self.name = f"sqlite://{self.path.as_posix()}"
+
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.executescript(_SQLITE_SCHEMA)
+        self._migrate()
+
+    def _migrate(self) -> None:
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(mangas)")}
+        if "archived_up_to" not in columns:
+            self.conn.execute("ALTER TABLE mangas ADD COLUMN archived_up_to REAL")
+        if "source_stats" not in columns:
+            self.conn.execute("ALTER TABLE mangas ADD COLUMN source_stats TEXT")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _chapters(self, name: str, table: str = "chapters") -> list[MangaChapter]:
+        rows = self.conn.execute(
+            f"SELECT url, num, timestamp FROM {table} WHERE manga = ?", (name,)
+        )
+        return [
+            MangaChapter(url=url, num=num, timestamp=datetime.fromisoformat(ts))
+            for url, num, ts in rows
+        ]
+
+    def load(self) -> list[Manga]:
+        with self.lock:
+            chapter_rows = self.conn.execute(
+                "SELECT manga, url, num, timestamp FROM chapters"
+            ).fetchall()
+            rows = self.conn.execute(
+                "SELECT name, source, archived_up_to, source_stats FROM mangas"
+            ).fetchall()
+
+        chapters: dict[str, list[MangaChapter]] = {}
+        for name, url, num, ts in chapter_rows:
+            chapter = MangaChapter(
+                url=url, num=num, timestamp=datetime.fromisoformat(ts)
+            )
+            chapters.setdefault(name, []).append(chapter)
+
+        return [
+            Manga(
+                name=name,
+                source=source,
+                chapters=chapters.get(name, []),
+                archived_up_to=archived_up_to,
+                source_stats=orjson.loads(source_stats) if source_stats else {},
+            )
+            for name, source, archived_up_to, source_stats in rows
+        ]
+
+    def _insert_chapters(
+        self, name: str, chapters: Iterable[MangaChapter], table: str = "chapters"
+    ) -> None:
+        self.conn.executemany(
+            f"INSERT OR IGNORE INTO {table} (manga, url, num, timestamp) VALUES (?, ?, ?, ?)",
+            [(name, c.url, c.num, c.timestamp.isoformat()) for c in chapters],
+        )
+
+    def load_archive(self, name: str) -> list[MangaChapter]:
+        return sorted(
+            self._chapters(name, table="archived_chapters"), key=lambda x: x.num
+        )
+
+    def archive(self, name: str, chapters: Iterable[MangaChapter]) -> None:
+        with self.conn:
+            self._insert_chapters(name, chapters, table="archived_chapters")
+
+    def load_cursor(self) -> RunCursor:
+        row = self.conn.execute("SELECT content FROM run_cursor").fetchone()
+        return RunCursor() if row is None else RunCursor.model_validate_json(row[0])
+
+    def save_cursor(self, cursor: RunCursor) -> None:
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO run_cursor (id, content) VALUES (0, ?)",
+                (cursor.model_dump_json(),),
+            )
+
+    def save(self, mangas: list[Manga]) -> None:
+        rows = [
+            (
+                m.name,
+                m.source.value,
+                m.archived_up_to,
+                orjson.dumps(m.model_dump(mode="json")["source_stats"])
+                if m.source_stats
+                else None,
+            )
+            for m in mangas
+        ]
+        chapters = {(m.name, c.url): c for m in mangas for c in m.chapters}
+
+        with self.lock, self.conn:
+            known_rows = set(
+                self.conn.execute(
+                    "SELECT name, source, archived_up_to, source_stats FROM mangas"
+                )
+            )
+            names = {name for name, *_ in rows}
+            self.conn.executemany(
+                "DELETE FROM mangas WHERE name = ?",
+                [(name,) for name, *_ in known_rows if name not in names],
+            )
+            self.conn.executemany(
+                "INSERT INTO mangas (name, source, archived_up_to, source_stats)"
+                " VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (name) DO UPDATE"
+                " SET source = excluded.source,"
+                " archived_up_to = excluded.archived_up_to,"
+                " source_stats = excluded.source_stats",
+                [row for row in rows if row not in known_rows],
+            )
+
+            known = set(self.conn.execute("SELECT manga, url FROM chapters"))
+            self.conn.executemany(
+                "DELETE FROM chapters WHERE manga = ? AND url = ?",
+                known - chapters.keys(),
+            )
+            self.conn.executemany(
+                "INSERT INTO chapters (manga, url, num, timestamp) VALUES (?, ?, ?, ?)",
+                [
+                    (name, url, c.num, c.timestamp.isoformat())
+                    for (name, url), c in chapters.items()
+                    if (name, url) not in known
+                ],
+            )
+
+
+class MemoryStateStore(StateStore):
+    """Authoritative state of a long-lived process, written behind to `backing`.
+
+    The state is loaded once, from the local `snapshot` if any, and saves only update
+    the mangas that changed in memory. They are flushed to `backing` by a background
+    thread every `flush_interval` seconds, or as soon as `flush_after` mangas changed,
+    and on close. The snapshot is written on each flush for a fast warm restart, which
+    is only safe if this process is the sole writer of the state.
+    """
+
+    def __init__(
+        self,
+        backing: StateStore,
+        *,
+        snapshot: str | Path | None = None,
+        flush_interval: float = 30.0,
+        flush_after: int = 50,
+    ) -> None:
+        self.backing = backing
+        self.snapshot = Path(snapshot) if snapshot else None
+        self.flush_interval = flush_interval
+        self.flush_after = flush_after
+        self.name = f"memory+{backing.name}"
+
+        if self.snapshot is not None and self.snapshot.exists():
+            mangas = [Manga(**e) for e in orjson.loads(self.snapshot.read_bytes())]
+            logger.info("loaded-snapshot", path=str(self.snapshot), nmangas=len(mangas))
+        else:
+            mangas = backing.load()
+        self.mangas = {m.name: m for m in mangas}
+        self.nchanges = 0
+
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.flusher = threading.Thread(
+            target=self._flush_periodically, name="neatpush-flush", daemon=True
+        )
+        self.flusher.start()
+
+    def load(self) -> list[Manga]:
+        with self.lock:
+            return list(self.mangas.values())
+
+    def save(self, mangas: list[Manga]) -> None:
+        with self.lock:
+            updated = {m.name: m for m in mangas}
+            removed = self.mangas.keys() - updated.keys()
+            changed = [m for m in mangas if self.mangas.get(m.name) != m]
+            self.mangas = updated
+            self.nchanges += len(removed) + len(changed)
+            if self.nchanges >= self.flush_after:
+                self.wake.set()
+
+    def flush(self) -> None:
+        with self.lock:
+            if not self.nchanges:
+                return
+            mangas, nchanges = list(self.mangas.values()), self.nchanges
+            self.nchanges = 0
+
+        try:
+            self.backing.save(mangas)
+        except Exception:
+            logger.exception("flush-failed", store=self.backing.name)
+            with self.lock:
+                self.nchanges += nchanges  # retried by the next flush
+            return
+
+        if self.snapshot is not None:
+            tmp = self.snapshot.with_suffix(".tmp")
+            tmp.write_bytes(orjson.dumps([m.model_dump() for m in mangas]))
+            tmp.replace(self.snapshot)
+        logger.info("flushed-state", store=self.backing.name, nchanges=nchanges)
+
+    def _flush_periodically(self) -> None:
+        while not self.closed:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def close(self) -> None:
+        """Stop flushing in the background, after a last flush."""
+        self.closed = True
+        self.wake.set()
+        self.flusher.join()
+        self.flush()
+
+    def archive(self, name: str, chapters: Iterable[MangaChapter]) -> None:
+        self.backing.archive(name, chapters)
+
+    def load_archive(self, name: str) -> list[MangaChapter]:
+        return self.backing.load_archive(name)
+
+    def load_cursor(self) -> RunCursor:
+        return self.backing.load_cursor()
+
+    def save_cursor(self, cursor: RunCursor) -> None:
+        self.backing.save_cursor(cursor)
+
+
+def sync_stores(src: StateStore, dst: StateStore) -> list[Manga]:
+    mangas = src.load()
+    dst.save(mangas)
+    logger.info("synced-stores", src=src.name, dst=dst.name, nmangas=len(mangas))
+    return mangas
@@ -0,0 +1,73 @@
+"""Several users sharing a single neatpush deployment.
+
+Subscribers are read from the JSON file at `SUBSCRIPTIONS_PATH`, each one with the
+mangas it watches per source and the apprise urls to notify it on:
+
+    [{"name": "alice", "targets": ["spush://key"], "mangas": {"mangapill": ["dandadan"]}}]
+
+The union of their watchlists is checked once per run, so the scraping cost grows
+with the number of distinct titles rather than with the number of subscribers. New
+chapters are then sent in a single notification to all the subscribers sharing the
+same diff.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Iterator
+from pathlib import Path
+
+import apprise
+from pydantic import BaseModel, TypeAdapter
+
+from neatpush.models import MangaSource
+from neatpush.scraping import MangaChapter
+
+
+class Subscriber(BaseModel):
+    name: str
+    targets: list[str]  # apprise urls
+    mangas: dict[MangaSource, list[str]]
+
+    @property
+    def watched(self) -> set[str]:
+        return {
+            entry.partition("=")[0] for names in self.mangas.values() for entry in names
+        }
+
+
+_subscribers_adapter = TypeAdapter(list[Subscriber])
+
+
+def load_subscribers(path: Path) -> list[Subscriber]:
+    return _subscribers_adapter.validate_json(path.read_bytes())
+
+
+def get_watchlist(subscribers: list[Subscriber]) -> dict[MangaSource, list[str]]:
+    """Union of the subscribers watchlists, each title listed once per source."""
+    map_manga_source: dict[MangaSource, list[str]] = {}
+    for subscriber in subscribers:
+        for source, names in subscriber.mangas.items():
+            known = map_manga_source.setdefault(source, [])
+            known.extend(name for name in names if name not in known)
+    return map_manga_source
+
+
+def fan_out(
+    subscribers: list[Subscriber], map_new_chapters: dict[str, list[MangaChapter]]
+) -> Iterator[tuple[apprise.Apprise, dict[str, list[MangaChapter]]]]:
+    """Batch subscribers by the new chapters they are concerned with.
+
+    Yield an apprise manager targeting all the subscribers of a batch, along with
+    their new chapters.
+    """
+    batches: dict[frozenset[str], list[Subscriber]] = {}
+    for subscriber in subscribers:
+        names = frozenset(subscriber.watched & map_new_chapters.keys())
+        if names:
+            batches.setdefault(names, []).append(subscriber)
+
+    for names, batch in batches.items():
+        manager = apprise.Apprise()
+        for target in {t for subscriber in batch for t in subscriber.targets}:
+            manager.add(target)
+        yield manager, {name: map_new_chapters[name] for name in sorted(names)}
@@ -1,10 +1,53 @@
+from datetime import UTC, datetime, timedelta
+
 import pytest
 from vcr import VCR
 from vcr.persisters.filesystem import FilesystemPersister as VCRFilesystemPersister
 
+from neatpush.models import Manga, MangaSource
+from neatpush.scraping import MangaChapter
+from neatpush.state import SQLiteStateStore
 from tests import VCR_DIR
 
 
+def make_chapters(name, *nums, source=MangaSource.mangapill):
+    return [
+        MangaChapter(
+            url=f"https://{source.value}.com/chapters/{name}-{num}",
+            num=num,
+            timestamp=datetime(2024, 1, 1, tzinfo=UTC) + timedelta(days=num),
+        )
+        for num in nums
+    ]
+
+
+def make_manga(name, *nums, source=MangaSource.mangapill):
+    return Manga(name=name, source=source, chapters=make_chapters(name, *nums))
+
+
+def load_manga(store, name):
+    return next((m for m in store.load() if m.name == name), None)
+
+
+@pytest.fixture
+def mock_sources(mocker, tmp_path):
+    """Check mangas against a sqlite store, and fake scrapers if given.
+
+    Returns a function taking the `{source: (fetch, parse)}` scrapers and the mangas
+    already known, and returning the store.
+    """
+    store = SQLiteStateStore(tmp_path / "state.sqlite")
+    mocker.patch("neatpush.manga.get_state_store", return_value=store)
+
+    def _mock(scrapers=None, mangas=()):
+        if scrapers is not None:
+            mocker.patch.dict("neatpush.manga.map_source_scrapers", scrapers)
+        store.save(list(mangas))
+        return store
+
+    return _mock
+
+
 @pytest.fixture(scope="session")
 def vcr():
     vcr = VCR(decode_compressed_response=False)
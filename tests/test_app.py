@@ -0,0 +1,133 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+import pytest
+from starlette.testclient import TestClient
+
+from neatpush.app import _CheckCache, app
+from neatpush.manga import iter_new_chapters
+from neatpush.models import MangaSource
+from tests.conftest import make_chapters, make_manga
+
+WATCHLIST = ["chainsaw-man", "one-punch-man", "dandadan"]
+
+
+def _parse(html):
+    if html == "dandadan":
+        raise ValueError("Layout changed")
+    return make_chapters(html, 1, 2)
+
+
+@pytest.fixture
+def mock_watchlist(mocker, mock_sources):
+    """Known mangas at their first chapter, the second one being published."""
+    mocker.patch("neatpush.config.CFG.MANGAPILL", WATCHLIST)
+
+    def _mock(fetch=lambda name: name):
+        return mock_sources(
+            {MangaSource.mangapill: (fetch, _parse)},
+            mangas=[make_manga(name, 1) for name in WATCHLIST],
+        )
+
+    return _mock
+
+
+def test_stream_chapters_check(mocker, mock_watchlist):
+    mock_watchlist()
+    notify = mocker.patch("neatpush.app.notify")
+
+    with TestClient(app).stream("POST", "/stream") as response:
+        assert response.headers["content-type"] == "application/x-ndjson"
+        results = {r["name"]: r for r in map(orjson.loads, response.iter_lines())}
+
+    assert results["chainsaw-man"]["status"] == "new-chapters"
+    assert [c["num"] for c in results["chainsaw-man"]["new_chapters"]] == [2]
+    assert results["dandadan"]["status"] == "error"
+    assert "Layout changed" in results["dandadan"]["errors"]["mangapill"]
+    assert set(notify.call_args.args[0]) == {"chainsaw-man", "one-punch-man"}
+
+    with TestClient(app).stream(
+        "GET", "/stream", headers={"accept": "text/event-stream"}
+    ) as response:
+        events = [line for line in response.iter_lines() if line]
+    assert len(events) == 3
+    assert all(event.startswith("data: ") for event in events)
+
+
+def test_cancelled_check_keeps_unchecked_titles(mock_watchlist):
+    cancel = threading.Event()
+
+    def fetch(name):
+        if name != "chainsaw-man":
+            cancel.wait()
+        return name
+
+    store = mock_watchlist(fetch=fetch)
+
+    checks = iter_new_chapters(cancel=cancel)
+    assert next(checks).name == "chainsaw-man"
+    cancel.set()
+    assert list(checks) == []
+
+    mangas = {m.name: m for m in store.load()}
+    assert set(mangas) == set(WATCHLIST)
+    assert mangas["chainsaw-man"].n_chapters == 2
+    assert mangas["one-punch-man"].n_chapters == 1
+
+
+def test_check_results_are_cached(mocker):
+    cache = _CheckCache()
+    mocker.patch("neatpush.app._check_cache", cache)
+    check = mocker.patch("neatpush.app.check_new_chapters", return_value={})
+    client = TestClient(app)
+
+    assert client.get("/").headers["x-cache"] == "MISS"
+    response = client.get("/")
+    assert response.headers["x-cache"] == "HIT"
+    assert response.headers["age"] == "0"
+    assert check.call_count == 1
+
+    assert client.get("/", params={"fresh": 1}).headers["x-cache"] == "MISS"
+    assert client.post("/").headers["x-cache"] == "MISS"
+    assert check.call_count == 3
+
+    mocker.patch("neatpush.config.CFG.CHECK_CACHE_TTL", 0)
+    assert client.get("/").headers["x-cache"] == "STALE"
+    cache.refresher.join()
+    assert check.call_count == 4
+
+
+def test_stream_and_post_share_a_single_run(mocker, mock_watchlist):
+    released = threading.Event()
+
+    def fetch(name):
+        released.wait(5)
+        return name
+
+    mock_watchlist(fetch=fetch)
+    mocker.patch("neatpush.app._check_cache", _CheckCache())
+    notify = mocker.patch("neatpush.app.notify")
+    client = TestClient(app)
+
+    with ThreadPoolExecutor(2) as executor:
+        stream = executor.submit(client.post, "/stream")
+        post = executor.submit(client.post, "/")
+        time.sleep(0.2)  # both are waiting on the scraping
+        released.set()
+        stream.result(), post.result()
+
+    # a single push, although both requests saw the new chapters
+    assert notify.call_count == 1
+
+
+def test_stream_reports_a_failed_check(mocker):
+    mocker.patch("neatpush.app._check_cache", _CheckCache())
+    mocker.patch("neatpush.manga.iter_new_chapters", side_effect=OSError("S3 down"))
+
+    with TestClient(app).stream("POST", "/stream") as response:
+        (record,) = map(orjson.loads, response.iter_lines())
+
+    assert record["status"] == "failed"
+    assert "S3 down" in record["error"]
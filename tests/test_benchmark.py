@@ -0,0 +1,72 @@
+import os
+import time
+
+import pytest
+
+from neatpush import scraping
+
+
+@pytest.fixture(scope="module")
+def html(vcr):
+    with vcr.use_cassette("scrap_overgeared.yaml"):
+        return scraping.fetch_neatmanga("overgeared")
+
+
+def test_it_can_parse_in_process_pool(html):
+    job = scraping.ScrapJob(
+        source="neatmanga",
+        name="overgeared",
+        fetch=lambda name: html,
+        parse=scraping.parse_neatmanga,
+    )
+    (result,) = scraping.iter_scrap([job], parse_workers=2)
+
+    assert result.error is None
+    assert len(set(result.chapters)) == 160
+
+
+def _crash(html):
+    os._exit(1)  # e.g. a parsing worker killed by the OOM killer
+
+
+def test_it_recovers_from_a_broken_process_pool(html):
+    crashing = scraping.ScrapJob(
+        source="neatmanga", name="overgeared", fetch=lambda name: html, parse=_crash
+    )
+    (result,) = scraping.iter_scrap([crashing], parse_workers=1)
+    assert result.error is not None
+
+    # the next runs get a new pool
+    job = scraping.ScrapJob(
+        source="neatmanga",
+        name="overgeared",
+        fetch=lambda name: html,
+        parse=scraping.parse_neatmanga,
+    )
+    (result,) = scraping.iter_scrap([job], parse_workers=1)
+    assert result.error is None
+
+
+@pytest.mark.stress
+@pytest.mark.parametrize("workers", [1, 2, 4, 8])
+def test_parsing_throughput(html, workers):
+    npages = 8
+    jobs = [
+        scraping.ScrapJob(
+            source="neatmanga",
+            name=f"title-{i}",
+            fetch=lambda name: html,
+            parse=scraping.parse_neatmanga,
+        )
+        for i in range(npages)
+    ]
+
+    # warm up the pool so that spawning the processes is not measured
+    list(scraping.iter_scrap(jobs[:workers], parse_workers=workers))
+
+    start = time.perf_counter()
+    results = list(scraping.iter_scrap(jobs, parse_workers=workers))
+    elapsed = time.perf_counter() - start
+
+    assert all(r.error is None for r in results)
+    print(f"\n{workers} workers: {npages / elapsed:.2f} pages/s")
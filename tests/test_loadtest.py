@@ -0,0 +1,82 @@
+import httpx
+import pytest
+
+from neatpush.loadtest import (
+    ServerThread,
+    SiteProfile,
+    fake_madara_app,
+    fake_s3_app,
+    run_fetch_benchmark,
+    run_loadtest,
+)
+from neatpush.s3 import S3Client, S3FileDoesNotExist, S3RequestError
+
+
+@pytest.fixture(scope="module")
+def s3_server():
+    with ServerThread(fake_s3_app("key", "secret", "fr-par")) as server:
+        yield server
+
+
+def _client(server, secret="secret"):
+    return S3Client(
+        access_key="key",
+        secret_key=secret,
+        bucket="bucket",
+        base_url=server.url,
+        region="fr-par",
+    )
+
+
+def test_fake_s3_roundtrip(s3_server):
+    client = _client(s3_server)
+
+    with pytest.raises(S3FileDoesNotExist):
+        client.download("state.json")
+
+    client.upload("state.json", b"[]")
+    assert client.download("state.json") == b"[]"
+
+
+def test_fake_s3_checks_signature(s3_server):
+    client = _client(s3_server, secret="wrong-secret")
+
+    with pytest.raises(S3RequestError) as excinfo:
+        client.upload("state.json", b"[]")
+    assert excinfo.value.status == 403
+
+
+def test_fake_madara_serves_the_real_urls():
+    profile = SiteProfile(ntitles=1, nchapters=5, latency=0)
+    (title,) = profile.titles("toonily")
+    with ServerThread(fake_madara_app(profile, "toonily")) as server:
+        for path in ("ajax/chapters/", "ajax/chapters"):
+            response = httpx.post(f"{server.url}/manga/{title}/{path}")
+            assert response.status_code == 200
+            assert "wp-manga-chapter" in response.text
+
+
+def test_run_loadtest():
+    profile = SiteProfile(ntitles=2, nchapters=5, latency=0.001)
+    runs_stats, app_stats = run_loadtest(profile, runs=2, requests=2, concurrency=1)
+
+    assert len(runs_stats.latencies) == 2
+    assert runs_stats.throughput > 0
+    assert len(app_stats.latencies) == 2
+
+
+def test_fetch_benchmark():
+    profile = SiteProfile(ntitles=2, nchapters=20, latency=0)
+    results = {r.name: r for r in run_fetch_benchmark(profile)}
+
+    assert set(results) == {
+        "neatmanga/ajax",
+        "neatmanga/page",
+        "mangapill/page",
+        "toonily/ajax",
+        "toonily/page",
+    }
+    for site in ("neatmanga", "toonily"):
+        ajax, page = results[f"{site}/ajax"], results[f"{site}/page"]
+        assert ajax.nbytes < page.nbytes
+        assert len(ajax.latencies) == 2
@@ -0,0 +1,37 @@
+import io
+
+import orjson
+import structlog
+
+from neatpush import config
+from neatpush.config import LazyRepr, setup_logging
+
+
+def test_json_logging(monkeypatch):
+    stream = io.BytesIO()
+    stream.close = lambda: None
+    monkeypatch.setattr(config, "_log_writer", config._QueueWriter(stream))
+    monkeypatch.setattr(config.CFG, "LOG_DEBUG_SAMPLE_RATE", 0.0)
+
+    calls = []
+
+    def summarize():
+        calls.append(1)
+        return "summary"
+
+    try:
+        setup_logging(level="info", fmt="json")
+        logger = structlog.getLogger("neatpush")
+        logger.debug("hidden", payload=LazyRepr(summarize))
+        logger.info("notifying", payload=LazyRepr(summarize))
+        setup_logging(level="debug", fmt="json")
+        logger.debug("sampled-out")
+        config._log_writer.close()
+    finally:
+        setup_logging(fmt="console")
+
+    events = [orjson.loads(line) for line in stream.getvalue().splitlines()]
+    assert [e["event"] for e in events] == ["notifying"]
+    assert events[0]["payload"] == "summary"
+    assert events[0]["level"] == "info"
+    assert len(calls) == 1  # only formatted once rendered
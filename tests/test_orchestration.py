@@ -1,4 +1,10 @@
-from neatpush.manga import MangaSource, get_new_chapters
+import threading
+
+import pytest
+
+from neatpush.manga import compact_mangas, get_new_chapters, iter_new_chapters
+from neatpush.models import Manga, MangaSource, SourceStats
+from tests.conftest import load_manga, make_chapters, make_manga
 
 
 def test_get_new_chapters(mocker, vcr):
@@ -32,3 +38,136 @@ def test_get_new_chapters(mocker, vcr):
 
     assert len(result["chainsaw-man"]) == 1
     assert result["chainsaw-man"][0].num == chapter.num
+
+
+def test_get_new_chapters_after_compaction(vcr, mock_sources):
+    store = mock_sources()
+
+    map_manga_source = {MangaSource.mangapill: ["chainsaw-man"]}
+    cassette = "orchestration.yaml"
+    with vcr.use_cassette(cassette):
+        get_new_chapters(map_manga_source)
+
+    mangas = compact_mangas(store, store.load(), keep=10)
+    manga = mangas[0]
+    assert manga.n_chapters == 10
+    assert len(store.load_archive("chainsaw-man")) == 122
+    assert manga.archived_up_to == store.load_archive("chainsaw-man")[-1].num
+
+    chapter = manga.chapters.pop()
+    store.save(mangas)
+
+    with vcr.use_cassette(cassette):
+        result = get_new_chapters(map_manga_source)
+
+    # old chapters are not seen as new, and the state is kept small
+    assert result["chainsaw-man"] == [chapter]
+    assert load_manga(store, "chainsaw-man").n_chapters == 10
+
+
+def test_get_new_chapters_races_sources(mock_sources):
+    published = {MangaSource.mangapill: [1, 2], MangaSource.neatmanga: [1]}
+
+    def scrapers(source):
+        def fetch(slug):
+            return source.value
+
+        def parse(html):
+            source = MangaSource(html)
+            return make_chapters("chainsaw-man", *published[source], source=source)
+
+        return fetch, parse
+
+    store = mock_sources({s: scrapers(s) for s in published})
+    map_manga_source = {
+        MangaSource.mangapill: ["chainsaw-man"],
+        MangaSource.neatmanga: ["chainsaw-man=chainsaw-man-manga"],
+    }
+
+    assert get_new_chapters(map_manga_source) == {}
+    assert [c.num for c in load_manga(store, "chainsaw-man").chapters] == [1, 2]
+
+    # mangapill publishes first, neatmanga's copy is not notified again
+    published[MangaSource.mangapill].append(3)
+    result = get_new_chapters(map_manga_source)
+    assert [c.url for c in result["chainsaw-man"]] == [
+        "https://mangapill.com/chapters/chainsaw-man-3"
+    ]
+
+    published[MangaSource.neatmanga].extend([2, 3])
+    assert get_new_chapters(map_manga_source) == {}
+
+    stats = load_manga(store, "chainsaw-man").source_stats
+    assert stats[MangaSource.mangapill].leads == 1
+    assert stats[MangaSource.neatmanga].lags == 2
+    assert stats[MangaSource.neatmanga].lag_seconds > 0
+    assert load_manga(store, "chainsaw-man").n_chapters == 3
+
+
+def test_slow_sources_are_checked_less_often():
+    manga = Manga(
+        name="chainsaw-man",
+        source=MangaSource.mangapill,
+        chapters=[],
+        source_stats={
+            MangaSource.mangapill: SourceStats(leads=10),
+            MangaSource.neatmanga: SourceStats(lags=10),
+        },
+    )
+    assert manga.should_check(MangaSource.mangapill)
+    checks = [manga.should_check(MangaSource.neatmanga) for _ in range(4)]
+    assert checks == [False, False, False, True]
+
+
+def _parse(html):
+    return make_chapters(html, 1, 2)
+
+
+def test_budgeted_run_resumes_unchecked_titles(mock_sources):
+    names = ["chainsaw-man", "dandadan", "one-punch-man"]
+    released = threading.Event()
+
+    def fetch(name):
+        if name == "dandadan":
+            released.wait(5)
+        return name
+
+    store = mock_sources(
+        {MangaSource.mangapill: (fetch, _parse)},
+        mangas=[make_manga(name, 1) for name in names],
+    )
+    map_manga_source = {MangaSource.mangapill: names}
+
+    try:
+        result = get_new_chapters(map_manga_source, budget=0.5)
+    finally:
+        released.set()
+
+    assert set(result) == {"chainsaw-man", "one-punch-man"}
+    assert store.load_cursor().unchecked == ["dandadan"]
+    assert load_manga(store, "dandadan").n_chapters == 1  # unchanged
+
+    # the next run starts with the unchecked titles
+    result = get_new_chapters(map_manga_source, budget=5)
+    assert set(result) == {"dandadan"}
+    assert store.load_cursor().unchecked == []
+
+
+def test_checkpointed_run_keeps_chapters_to_notify(mocker, mock_sources):
+    mocker.patch("neatpush.config.CFG.CHECKPOINT_EVERY", 1)
+    store = mock_sources(
+        {MangaSource.mangapill: (lambda name: name, _parse)},
+        mangas=[make_manga("dandadan", 1)],
+    )
+    map_manga_source = {MangaSource.mangapill: ["dandadan"]}
+
+    checks = iter_new_chapters(map_manga_source)
+    assert [c.num for c in next(checks).new_chapters] == [2]
+    with pytest.raises(RuntimeError):
+        checks.throw(RuntimeError("killed before notifying"))
+
+    assert load_manga(store, "dandadan").n_chapters == 2
+    # the chapters found are not lost, although already saved in the state
+    result = get_new_chapters(map_manga_source)
+    assert [c.num for c in result["dandadan"]] == [2]
+    assert store.load_cursor().pending == {}
@@ -0,0 +1,81 @@
+import time
+
+import httpx
+import pytest
+
+from neatpush.s3 import RetryPolicy, S3Client
+
+NO_WAIT = RetryPolicy(backoff=0, max_attempts=3)
+
+
+def _client(handler, **kwargs):
+    client = httpx.Client(
+        base_url="https://s3.test", transport=httpx.MockTransport(handler)
+    )
+    return S3Client(
+        access_key="key",
+        secret_key="secret",
+        bucket="bucket",
+        base_url="https://s3.test",
+        region="fr-par",
+        client=client,
+        **kwargs,
+    )
+
+
+def test_it_retries_on_throttling_and_disconnects():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            raise httpx.RemoteProtocolError("Server disconnected")
+        if len(calls) == 2:
+            return httpx.Response(503, text="SlowDown")
+        return httpx.Response(200, content=b"[]")
+
+    client = _client(handler, retry_policy=NO_WAIT)
+    assert client.download("state.json") == b"[]"
+    assert len(calls) == 3
+
+
+def test_it_stops_retrying_after_max_attempts():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(500)
+
+    client = _client(handler, retry_policy=NO_WAIT)
+    with pytest.raises(httpx.HTTPStatusError):
+        client.download("state.json")
+    assert len(calls) == 3
+
+
+def test_it_does_not_retry_client_errors():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(403)
+
+    client = _client(handler, retry_policy=NO_WAIT)
+    with pytest.raises(httpx.HTTPStatusError):
+        client.download("state.json")
+    assert len(calls) == 1
+
+
+def test_hedged_gets_cut_tail_latency():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            time.sleep(1)  # slow tail response
+        return httpx.Response(200, content=str(len(calls)).encode())
+
+    client = _client(handler, retry_policy=NO_WAIT, hedge_gets=True, hedge_delay=0.05)
+
+    start = time.perf_counter()
+    assert client.download("state.json") == b"2"
+    assert time.perf_counter() - start < 0.5
@@ -16,3 +16,36 @@ def test_it_can_retrieve_chapters(vcr, name, scraping_fn, nchapters_expected):
         results = scraping_fn(name)
 
     assert len(results) == nchapters_expected
+
+
+def test_it_falls_back_to_the_next_fetch_strategy(mocker):
+    mocker.patch.dict(scraping._working_strategies, clear=True)
+    ajax = mocker.Mock(side_effect=scraping.ScrapingError("ajax disabled"))
+    page = mocker.Mock(return_value="<li class='wp-manga-chapter'></li>")
+    mocker.patch.dict(
+        scraping.FETCH_STRATEGIES, {"toonily": [("ajax", ajax), ("page", page)]}
+    )
+    fetch = scraping.fetch_with_fallback("toonily")
+
+    assert fetch("omniscient-reader") == page.return_value
+    assert scraping._working_strategies["toonily"][0] == "page"
+
+    # the working strategy is used first from now on
+    fetch("omniscient-reader")
+    assert ajax.call_count == 1
+    assert page.call_count == 2
+
+
+def test_missing_manga_is_not_a_fetch_strategy_failure(mocker):
+    mocker.patch.dict(scraping._working_strategies, clear=True)
+    ajax = mocker.Mock(side_effect=scraping.MangaNotFound("removed-manga"))
+    page = mocker.Mock()
+    mocker.patch.dict(
+        scraping.FETCH_STRATEGIES, {"toonily": [("ajax", ajax), ("page", page)]}
+    )
+    fetch = scraping.fetch_with_fallback("toonily")
+
+    with pytest.raises(scraping.MangaNotFound):
+        fetch("removed-manga")
+    page.assert_not_called()
+    assert "toonily" not in scraping._working_strategies
@@ -0,0 +1,147 @@
+import time
+from functools import partial
+
+import pytest
+from pydantic import SecretStr
+from typer.testing import CliRunner
+
+from neatpush.__main__ import cli
+from neatpush.app import check_new_chapters
+from neatpush.loadtest import ServerThread, fake_s3_app, override_config
+from neatpush.manga import _get_s3_client, get_state_store
+from neatpush.models import MangaSource
+from neatpush.sharding import (
+    LeaseManager,
+    Shard,
+    load_shard_notifs,
+    merge_shards,
+    save_shard_notifs,
+)
+from tests.conftest import load_manga, make_chapters, make_manga
+
+
+@pytest.fixture
+def s3_bucket():
+    with (
+        ServerThread(fake_s3_app("key", "secret", "fr-par")) as server,
+        override_config(
+            BUCKET_ENDPOINT_URL=server.url,
+            CLOUD_ACCESS_KEY="key",
+            CLOUD_SECRET_KEY=SecretStr("secret"),
+            CLOUD_REGION_NAME="fr-par",
+            STATE_BACKEND="s3",
+        ),
+    ):
+        yield server.app.state.objects
+
+
+def test_shards_partition_titles():
+    names = [f"title-{i}" for i in range(100)]
+    shards = Shard.all(4)
+
+    for name in names:
+        assert sum(shard.owns(name) for shard in shards) == 1
+
+    assert Shard.parse("1/4") == shards[1]
+    assert shards[1].key("neatpush.json") == "neatpush.shard-1-of-4.json"
+
+    with pytest.raises(ValueError):
+        Shard.parse("4/4")
+
+
+def test_merge_shards(s3_bucket):
+    names = [f"title-{i}" for i in range(10)]
+    shards = Shard.all(2)
+
+    # only the first shard ran, with a new chapter
+    main = [make_manga(name, 1) for name in names]
+    get_state_store().save(main)
+    owned = [make_manga(name, 1, 2) for name in names if shards[0].owns(name)]
+    get_state_store(shard=shards[0]).save(owned)
+
+    s3client = _get_s3_client()
+    notifs = {m.name: m.chapters[-1:] for m in owned}
+    save_shard_notifs(s3client, shards[0], notifs)
+
+    late = {"title-late": make_chapters("title-late", 3)}
+    notified = []
+
+    def notify(to_notify):
+        notified.append(to_notify)
+        # a shard worker saving its notifs while the merge is notifying
+        save_shard_notifs(s3client, shards[0], late)
+
+    merge_shards(2, notify=notify)
+
+    assert notified == [notifs]
+    # the late notifs are kept for the next merge
+    assert load_shard_notifs(s3client, shards[0])[1] == late
+
+    merged = {m.name: m for m in get_state_store().load()}
+    assert set(merged) == set(names)
+    for name, manga in merged.items():
+        assert manga.n_chapters == (2 if shards[0].owns(name) else 1)
+
+
+def test_leases(s3_bucket):
+    shard = Shard(index=0, count=1)
+    s3client = _get_s3_client()
+    worker_a = LeaseManager(s3client, owner="a", settle=0)
+    worker_b = LeaseManager(s3client, owner="b", settle=0)
+
+    assert worker_a.acquire(shard)
+    assert not worker_b.acquire(shard)
+
+    worker_a.release(shard)
+    assert [claimed for claimed, _ in worker_b.claim_shards(1)] == [shard]
+
+    # the lease is kept once done, so the shard is not processed twice in a cycle
+    assert worker_b.get(shard).owner == "b"
+    assert not worker_a.acquire(shard)
+
+
+def test_lost_lease_discards_the_shard_run(s3_bucket, mocker, mock_sources):
+    shard = Shard(index=0, count=1)
+    s3client = _get_s3_client()
+    worker_a = LeaseManager(s3client, owner="a", ttl=0.3, settle=0)
+    worker_b = LeaseManager(s3client, owner="b", settle=0)
+
+    def fetch(name):
+        worker_b._write(shard)  # taken over while still scraping
+        lost.wait(5)
+        return name
+
+    mocker.patch("neatpush.config.CFG.MANGAPILL", ["dandadan"])
+    store = mock_sources(
+        {MangaSource.mangapill: (fetch, lambda name: make_chapters(name, 1, 2))},
+        mangas=[make_manga("dandadan", 1)],
+    )
+
+    with worker_a.hold(shard) as lost:
+        assert check_new_chapters(shard=shard, lost=lost) == {}
+
+    assert lost.is_set()
+    # neither the state nor the notifs are written, and the lease is left as is
+    assert load_manga(store, "dandadan").n_chapters == 1
+    assert load_shard_notifs(s3client, shard) == ([], {})
+    assert worker_b.get(shard).owner == "b"
+
+
+def test_lease_run_shares_its_budget(s3_bucket, mocker):
+    mocker.patch("neatpush.__main__.LeaseManager", partial(LeaseManager, settle=0))
+    budgets = []
+
+    def check_new_chapters(shard, budget, lost):
+        budgets.append(budget)
+        # the first shard spends most of the budget, the second one all that is left
+        time.sleep(budget * 0.6 if len(budgets) == 1 else budget)
+
+    mocker.patch("neatpush.__main__.check_new_chapters", check_new_chapters)
+    with override_config(SHARD_COUNT=4):
+        result = CliRunner().invoke(cli, ["run", "--lease", "--budget", "2"])
+
+    assert result.exit_code == 0, result.output
+    # the second shard only gets what is left, and no more shards are claimed
+    assert len(budgets) == 2
+    assert budgets[0] <= 2
+    assert budgets[1] < budgets[0] * 0.4
@@ -0,0 +1,104 @@
+import time
+
+import pytest
+
+from neatpush.s3 import S3FileDoesNotExist
+from neatpush.state import (
+    MemoryStateStore,
+    S3StateStore,
+    SQLiteStateStore,
+    sync_stores,
+)
+from tests.conftest import load_manga, make_chapters, make_manga
+
+
+def test_sqlite_store_roundtrip(tmp_path):
+    store = SQLiteStateStore(tmp_path / "state.sqlite")
+    assert store.load() == []
+
+    manga = make_manga("chainsaw-man", 1, 2)
+    store.save([manga])
+    assert store.load() == [manga]
+
+    manga = manga.merge(make_chapters("chainsaw-man", 3))
+    store.save([manga])
+    assert load_manga(store, "chainsaw-man").n_chapters == 3
+
+    # chapters removed from a manga are removed from the store as well
+    manga.chapters.pop(0)
+    store.save([manga])
+    assert [c.num for c in load_manga(store, "chainsaw-man").chapters] == [2, 3]
+
+    store.save([])
+    assert store.load() == []
+
+
+def test_sqlite_store_reads_each_table_once(tmp_path):
+    store = SQLiteStateStore(tmp_path / "state.sqlite")
+    mangas = [make_manga(f"title-{i}", 1, 2) for i in range(20)]
+    store.save(mangas)
+
+    statements = []
+    store.conn.set_trace_callback(statements.append)
+
+    assert store.load() == mangas
+    mangas[0] = mangas[0].merge(make_chapters("title-0", 3))
+    store.save(mangas)
+
+    selects = [s for s in statements if s.startswith("SELECT")]
+    assert len(selects) == 4  # chapters and mangas, on load and on save
+    # only the new chapter is written
+    writes = [s for s in statements if s.startswith(("INSERT", "UPDATE", "DELETE"))]
+    assert len(writes) == 1
+    assert "title-0-3" in writes[0]
+
+
+def test_sync_stores(tmp_path):
+    src = SQLiteStateStore(tmp_path / "src.sqlite")
+    dst = SQLiteStateStore(tmp_path / "dst.sqlite")
+
+    manga = make_manga("chainsaw-man", 1)
+    src.save([manga])
+
+    sync_stores(src, dst)
+    assert dst.load() == [manga]
+
+
+def test_s3_store_missing_state(mocker):
+    s3client = mocker.Mock(bucket="bucket")
+    s3client.download.side_effect = S3FileDoesNotExist("neatpush.json")
+
+    with pytest.raises(S3FileDoesNotExist):
+        S3StateStore(s3client, key="neatpush.json").load()
+
+    store = S3StateStore(s3client, key="neatpush.json", allow_missing=True)
+    assert store.load() == []
+
+
+def test_memory_store_writes_behind(tmp_path, mocker):
+    backing = SQLiteStateStore(tmp_path / "state.sqlite")
+    snapshot = tmp_path / "snapshot.json"
+    store = MemoryStateStore(
+        backing, snapshot=snapshot, flush_interval=60, flush_after=2
+    )
+
+    manga = make_manga("chainsaw-man", 1)
+    store.save([manga])
+    assert store.load() == [manga]
+    assert backing.load() == []  # not flushed yet
+
+    other = manga.model_copy(update={"name": "dandadan"})
+    store.save([manga, other])  # flushed once 2 mangas changed
+    deadline = time.monotonic() + 5
+    while not backing.load() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert backing.load() == [manga, other]
+    store.close()
+    assert snapshot.exists()
+
+    # warm restart from the local snapshot
+    load = mocker.spy(backing, "load")
+    restarted = MemoryStateStore(backing, snapshot=snapshot)
+    assert restarted.load() == [manga, other]
+    load.assert_not_called()
+    restarted.close()
@@ -0,0 +1,75 @@
+import orjson
+
+from neatpush.manga import get_new_chapters
+from neatpush.models import MangaSource
+from neatpush.tenants import Subscriber, fan_out, get_watchlist
+from tests.conftest import make_chapters, make_manga
+
+SUBSCRIBERS = [
+    Subscriber(
+        name="alice",
+        targets=["json://localhost/alice"],
+        mangas={MangaSource.mangapill: ["chainsaw-man", "dandadan"]},
+    ),
+    Subscriber(
+        name="bob",
+        targets=["json://localhost/bob"],
+        mangas={
+            MangaSource.mangapill: ["dandadan", "chainsaw-man"],
+            MangaSource.toonily: ["omniscient-reader"],
+        },
+    ),
+    Subscriber(
+        name="carol",
+        targets=["json://localhost/carol"],
+        mangas={MangaSource.mangapill: ["one-punch-man"]},
+    ),
+]
+
+
+def test_titles_are_scraped_once(mocker, tmp_path, mock_sources):
+    path = tmp_path / "subscriptions.json"
+    path.write_bytes(orjson.dumps([s.model_dump(mode="json") for s in SUBSCRIBERS]))
+    mocker.patch("neatpush.config.CFG.SUBSCRIPTIONS_PATH", path)
+
+    fetched = []
+
+    def scrapers(source):
+        def fetch(name):
+            fetched.append((source, name))
+            return name
+
+        return fetch, lambda name: make_chapters(name, 1, 2, source=source)
+
+    watchlist = get_watchlist(SUBSCRIBERS)
+    mock_sources(
+        {source: scrapers(source) for source in watchlist},
+        mangas=[make_manga(n, 1) for names in watchlist.values() for n in names],
+    )
+    new_chapters = get_new_chapters()
+
+    assert sorted(fetched) == [
+        (MangaSource.mangapill, "chainsaw-man"),
+        (MangaSource.mangapill, "dandadan"),
+        (MangaSource.mangapill, "one-punch-man"),
+        (MangaSource.toonily, "omniscient-reader"),
+    ]
+    assert set(new_chapters) == {n for names in watchlist.values() for n in names}
+
+
+def test_fan_out_batches_subscribers():
+    map_new_chapters = {
+        "chainsaw-man": make_chapters("chainsaw-man", 150),
+        "one-punch-man": make_chapters("one-punch-man", 200),
+    }
+
+    batches = sorted(
+        fan_out(SUBSCRIBERS, map_new_chapters), key=lambda batch: len(batch[0])
+    )
+    assert len(batches) == 2
+
+    (carol, carol_chapters), (alice_bob, alice_bob_chapters) = batches
+    assert len(carol) == 1
+    assert list(carol_chapters) == ["one-punch-man"]
+    assert len(alice_bob) == 2  # a single notification for both
+    assert list(alice_bob_chapters) == ["chainsaw-man"]